@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import statistics
+import multiprocessing
+import urllib.request
+
+import stubs
+
+# benchmark of broadcast cycle against local WB and telegram stand-ins, production APIs are not touched.
+# Every volume is measured in a separate process, so peak RSS of one volume doesn't include others.
+# Run from any directory: python bench/bench_cycle.py --output bench_output.json
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+shop_code = 'BN'
+drain_timeout = 300  # seconds, max wait until outbox is empty after cycle
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of broadcast cycle with WB and telegram stubs')
+    parser.add_argument('--volumes', type=int, nargs='+', default=[100, 5000, 50000],
+                        help='unanswered feedbacks in WB stub')
+    parser.add_argument('--cycles', type=int, default=10, help='measured cycles after warm-up one')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='share of unanswered feedbacks which are answered and replaced by new ones every cycle')
+    parser.add_argument('--overdue-share', type=float, default=0.1,
+                        help='share of new feedbacks which are already overdue when they appear')
+    parser.add_argument('--chats', type=int, default=5, help='subscribed chats of every bot')
+    parser.add_argument('--blocked-chats', type=int, default=1, help='chats which answer with 403')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='seconds, latency of telegram stub')
+    parser.add_argument('--tg-429-rate', type=float, default=0.01, help='share of telegram requests answered with 429')
+    parser.add_argument('--real-limits', action='store_true',
+                        help='keep telegram rate limits of tg_sender, otherwise sending is limited by stub only')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file for JSON result, it is printed to stdout anyway')
+    parser.add_argument('--volume', type=int, help=argparse.SUPPRESS)  # measure one volume in this process
+    return parser.parse_args()
+
+
+def get_git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if status != '' else '')
+    except Exception:
+        return None
+
+
+def get_json(url, method='GET'):
+    request = urllib.request.Request(url, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def subtract_calls(after, before):
+    return {key: value - before.get(key, 0) for key, value in after.items() if value - before.get(key, 0) != 0}
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def run_volume(args):
+    volume = args.volume
+    blocked_chats = list(range(1000, 1000 + args.blocked_chats))
+
+    # stubs are started before bot modules are imported, so forked process doesn't carry them
+    ports_queue = multiprocessing.Queue()
+    stub_process = multiprocessing.Process(target=stubs.run_stubs, daemon=True, args=(
+        ports_queue, volume, args.seed, args.tg_latency, args.tg_429_rate, blocked_chats))
+    stub_process.start()
+    wb_port, tg_port = ports_queue.get(timeout=60)
+    wb_url = f'http://127.0.0.1:{wb_port}'
+    tg_url = f'http://127.0.0.1:{tg_port}'
+
+    # bot works in temporary directory with its own config, db and logs
+    work_dir = tempfile.mkdtemp(prefix='wb_bench_')
+    with open(os.path.join(work_dir, 'config.json'), 'w', encoding='utf-8') as file:
+        json.dump({
+            'wb_api': {'base_url': wb_url, 'min_poll_interval': 0},
+            'logging': {'level': 'WARNING'},
+            'metrics': {},
+            'telegram': {'review_bot_token': '1:bench_review_bot', 'late_review_bot_token': '2:bench_late_review_bot'},
+            'shops': [{'code': shop_code, 'name': 'Bench shop', 'token': 'bench_token'}],
+        }, file)
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_dir)
+
+    import telebot
+    telebot.apihelper.API_URL = tg_url + '/bot{0}/{1}'
+
+    import wb
+    import main
+    import my_db
+    import my_enums
+    import tg_sender
+    import review_bot
+    import late_review_bot
+
+    # every transaction of every write connection is counted
+    commits = [0]
+    connect = my_db.connect
+
+    def traced_connect(read_only=False):
+        db = connect(read_only)
+        if not read_only:
+            db.set_trace_callback(lambda statement: commits.__setitem__(0, commits[0] + (statement == 'COMMIT')))
+        return db
+
+    my_db.connect = traced_connect
+
+    if not args.real_limits:
+        tg_sender.chat_rate = 1000
+        for sender in [review_bot.sender, late_review_bot.sender]:
+            sender.global_bucket = tg_sender.TokenBucket(1000, 1000)
+
+    shop = main.shops[0]
+    my_db.init(main.shops)
+    wb.init_overdue_reviews(main.shops)
+
+    # backlog of stub is already known, so the first cycle only loads it, new reviews are counted from now
+    my_db.update_last_check_date(shop, my_enums.NotifType.REVIEWS, int(time.time()))
+
+    for chat in list(range(1, args.chats + 1)) + blocked_chats:
+        my_db.add_chat(chat, 1, 1, 0)
+        my_db.add_late_review_chat(chat, 1)
+
+    review_bot.sender.start()
+    late_review_bot.sender.start()
+
+    def wait_for_outbox():
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < drain_timeout:
+            pending = sum(my_db.get_pending_notifications_count(sender.bot_name, tg_sender.max_attempts)
+                          for sender in [review_bot.sender, late_review_bot.sender])
+            if pending == 0:
+                break
+            time.sleep(0.01)
+
+        return time.perf_counter() - start_time
+
+    cycles = []
+    for cycle in range(args.cycles + 1):
+        if cycle > 0:
+            get_json(f'{wb_url}/bench/churn?count={max(1, int(volume * args.churn))}'
+                     f'&overdue_share={args.overdue_share}', method='POST')
+
+        wb_calls = get_json(f'{wb_url}/bench/stats')['calls']
+        tg_calls = get_json(f'{tg_url}/bench/stats')['calls']
+        cycle_commits = commits[0]
+
+        start_time = time.perf_counter()
+        activity = main.poll_shop(shop)
+        poll_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        overdue_answers = [(review_id, msg) for _, review_id, msg in wb.get_overdue_reviews()]
+        late_review_bot.send_msgs(overdue_answers, my_enums.NotifType.ANSWERS)
+        for review_id, _ in overdue_answers:
+            my_db.make_unanswered_review_dirty(review_id)
+        overdue_time = time.perf_counter() - start_time
+
+        drain_time = wait_for_outbox()
+
+        cycles.append({
+            'cycle': cycle,
+            'poll_seconds': round(poll_time, 4),
+            'overdue_seconds': round(overdue_time, 4),
+            'drain_seconds': round(drain_time, 4),
+            'new_reviews_and_answers': activity,
+            'overdue_reviews': len(overdue_answers),
+            'wb_calls': subtract_calls(get_json(f'{wb_url}/bench/stats')['calls'], wb_calls),
+            'tg_calls': subtract_calls(get_json(f'{tg_url}/bench/stats')['calls'], tg_calls),
+            'db_commits': commits[0] - cycle_commits,
+        })
+
+    stub_process.terminate()
+
+    measured = cycles[1:]
+    poll_times = [cycle['poll_seconds'] for cycle in measured]
+    cycle_times = [cycle['poll_seconds'] + cycle['overdue_seconds'] + cycle['drain_seconds'] for cycle in measured]
+
+    return {
+        'volume': volume,
+        'warm_up': cycles[0],
+        'poll_seconds': {'median': statistics.median(poll_times), 'p95': get_percentile(poll_times, 0.95),
+                         'max': max(poll_times)},
+        'cycle_seconds': {'median': round(statistics.median(cycle_times), 4),
+                          'p95': round(get_percentile(cycle_times, 0.95), 4), 'max': round(max(cycle_times), 4)},
+        'wb_calls': sum(sum(cycle['wb_calls'].values()) for cycle in measured),
+        'tg_calls': sum(sum(cycle['tg_calls'].values()) for cycle in measured),
+        'db_commits': sum(cycle['db_commits'] for cycle in measured),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'cycles': measured,
+    }
+
+
+def main():
+    args = parse_args()
+
+    if args.volume is not None:
+        print(json.dumps(run_volume(args)))
+        return
+
+    results = []
+    for volume in args.volumes:
+        command = [sys.executable, os.path.abspath(__file__), '--volume', str(volume)] + sys.argv[1:]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            sys.exit(f'benchmark of volume {volume} failed')
+
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+        sys.stderr.write(f'volume {volume}: poll median {result["poll_seconds"]["median"]} s, '
+                         f'cycle median {result["cycle_seconds"]["median"]} s, '
+                         f'peak RSS {result["peak_rss_kb"]} KB\n')
+
+    report = {
+        'git_revision': get_git_revision(),
+        'python': sys.version.split()[0],
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': {key: value for key, value in vars(args).items() if key not in ['output', 'volume']},
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
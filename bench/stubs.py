@@ -0,0 +1,227 @@
+import json
+import time
+import random
+import datetime
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# local stand-ins for WB feedbacks API and telegram bot API. They run in a separate process,
+# so memory and CPU of the bot are measured without them
+
+
+def format_sz_date(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class WbState:
+    def __init__(self, volume, seed):
+        self.locker = threading.Lock()
+        self.random = random.Random(seed)
+        self.next_id = 0
+        self.unanswered = {}  # {id: feedback json}
+        self.answered = {}
+        self.calls = {}  # {path: count}
+
+        # unanswered backlog, not old enough to be overdue while benchmark runs
+        cur_time = int(time.time())
+        for _ in range(volume):
+            self.add_feedback(cur_time - 60 - self.random.randint(0, 30))
+
+    def add_feedback(self, created_date):
+        feedback_id = f'bench{self.next_id:08d}'
+        nm_id = 100000 + self.random.randint(0, 999)
+        self.next_id += 1
+
+        self.unanswered[feedback_id] = {
+            'id': feedback_id,
+            'text': 'Отличный товар, <b>рекомендую</b> & ' * self.random.randint(0, 8),
+            'productValuation': self.random.randint(1, 5),
+            'createdDate': format_sz_date(created_date),
+            'createdTimestamp': created_date,  # only for stub filters
+            'productDetails': {
+                'nmId': nm_id,
+                'brandName': 'Bench brand',
+                'productName': f'Product {nm_id}',
+                'supplierArticle': f'ART-{nm_id}',
+                'size': self.random.choice(['S', 'M', 'L', '0']),
+            },
+            'answer': None,
+        }
+
+    # answer `count` reviews and add `count` new ones. Part of new reviews is created long ago,
+    # they are overdue as soon as they are fetched (WB shows some reviews with delay)
+    def churn(self, count, overdue_share):
+        with self.locker:
+            cur_time = int(time.time())
+
+            for feedback_id in self.random.sample(sorted(self.unanswered), min(count, len(self.unanswered))):
+                feedback = self.unanswered.pop(feedback_id)
+                feedback['answer'] = {'text': 'Спасибо за отзыв!'}
+                self.answered[feedback_id] = feedback
+
+            for _ in range(count):
+                is_overdue = self.random.random() < overdue_share
+                self.add_feedback(cur_time - 700 if is_overdue else cur_time)
+
+    def get_feedbacks(self, params):
+        with self.locker:
+            source = self.answered if params.get('isAnswered') == 'true' else self.unanswered
+            date_from = int(params.get('dateFrom', 0))
+            feedbacks = [feedback for feedback in source.values() if feedback['createdTimestamp'] >= date_from]
+
+        feedbacks.sort(key=lambda feedback: feedback['createdTimestamp'], reverse=params.get('order') != 'dateAsc')
+        skip = int(params.get('skip', 0))
+        take = int(params.get('take', 5000))
+
+        return {'data': {'feedbacks': feedbacks[skip:skip + take], 'countUnanswered': len(self.unanswered)},
+                'error': False}
+
+    def get_feedback(self, feedback_id):
+        with self.locker:
+            return self.answered.get(feedback_id) or self.unanswered.get(feedback_id)
+
+
+class TgState:
+    def __init__(self, latency, rate_429, blocked_chats, seed):
+        self.locker = threading.Lock()
+        self.random = random.Random(seed)
+        self.latency = latency  # seconds
+        self.rate_429 = rate_429  # share of requests answered with 429
+        self.blocked_chats = set(blocked_chats)  # these chats answer with 403
+        self.calls = {}  # {result: count}
+        self.message_id = 0
+
+    def count(self, result):
+        with self.locker:
+            self.calls[result] = self.calls.get(result, 0) + 1
+
+
+def make_wb_handler(state: WbState):
+    class WbHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like WB
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            # calls of benchmark itself are not counted
+            if url.path.startswith('/api/'):
+                with state.locker:
+                    state.calls[url.path] = state.calls.get(url.path, 0) + 1
+
+            if url.path == '/api/v1/feedbacks':
+                self.send_json(200, state.get_feedbacks(params))
+            elif url.path == '/api/v1/feedback':
+                feedback = state.get_feedback(params.get('id'))
+                if feedback is None:
+                    self.send_json(422, {'data': None, 'error': True,
+                                         'errorText': f'Feedback with id={params.get("id")} not found'})
+                else:
+                    self.send_json(200, {'data': feedback, 'error': False})
+            elif url.path == '/bench/stats':
+                with state.locker:
+                    self.send_json(200, {'calls': dict(state.calls), 'unanswered': len(state.unanswered),
+                                         'answered': len(state.answered)})
+            else:
+                self.send_json(404, {'error': True})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/bench/churn':
+                state.churn(int(params['count']), float(params['overdue_share']))
+                self.send_json(200, {'ok': True})
+            else:
+                self.send_json(404, {'error': True})
+
+        def send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return WbHandler
+
+
+def make_tg_handler(state: TgState):
+    class TgHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.do_POST()
+
+        def do_POST(self):
+            url = urlparse(self.path)
+
+            if url.path == '/bench/stats':
+                with state.locker:
+                    self.send_json(200, {'calls': dict(state.calls)})
+                return
+
+            # telebot sends params in query string or in form body
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8') if length > 0 else ''
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            params.update({key: values[0] for key, values in parse_qs(body).items()})
+
+            if not url.path.endswith('/sendMessage'):
+                self.send_json(200, {'ok': True, 'result': True})
+                return
+
+            time.sleep(state.latency)
+            chat_id = int(params.get('chat_id', 0))
+
+            if chat_id in state.blocked_chats:
+                state.count('403')
+                self.send_json(403, {'ok': False, 'error_code': 403,
+                                     'description': 'Forbidden: bot was blocked by the user'})
+            elif state.random.random() < state.rate_429:
+                state.count('429')
+                self.send_json(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                     'parameters': {'retry_after': 1}})
+            else:
+                state.count('ok')
+                with state.locker:
+                    state.message_id += 1
+                    message_id = state.message_id
+
+                self.send_json(200, {'ok': True, 'result': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', ''),
+                }})
+
+        def send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TgHandler
+
+
+# entry point of stub process. Ports are sent back through ports_queue: (wb port, tg port)
+def run_stubs(ports_queue, volume, seed, tg_latency, tg_rate_429, blocked_chats):
+    wb_server = ThreadingHTTPServer(('127.0.0.1', 0), make_wb_handler(WbState(volume, seed)))
+    tg_server = ThreadingHTTPServer(('127.0.0.1', 0), make_tg_handler(TgState(tg_latency, tg_rate_429,
+                                                                              blocked_chats, seed)))
+    wb_server.daemon_threads = True
+    tg_server.daemon_threads = True
+
+    threading.Thread(target=tg_server.serve_forever, daemon=True).start()
+    ports_queue.put((wb_server.server_address[1], tg_server.server_address[1]))
+    wb_server.serve_forever()
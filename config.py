@@ -0,0 +1,15 @@
+import json
+
+config_name = 'config.json'
+settings = None
+
+
+# settings are read from config.json once, on the first call
+def get(key, default=None):
+    global settings
+
+    if settings is None:
+        with open(config_name, 'r', encoding='utf-8') as file:
+            settings = json.load(file)
+
+    return settings.get(key, default)
@@ -0,0 +1,122 @@
+import time
+import queue
+import metrics
+import threading
+from concurrent.futures import Future
+from log_writer import get_logger
+
+logger = get_logger(__name__)
+
+batch_size = metrics.Histogram('db_write_batch_size', 'Writes committed in one transaction',
+                               buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+commit_time = metrics.Histogram('db_commit_seconds', 'Duration of transaction of writes batch')
+
+
+# the only thread which writes to db. Writes which come within batch_delay are committed in one transaction
+# (group commit), so callers don't wait for each other's commits and there is one fsync per batch.
+# Every write is run in its own savepoint, so failed write doesn't roll back others
+class DbWriter:
+    def __init__(self, connect, batch_delay=0.005, max_batch=200):
+        self.connect = connect  # returns connection in autocommit mode, transactions are managed here
+        self.batch_delay = batch_delay  # seconds
+        self.max_batch = max_batch
+        self.writes = queue.Queue()  # [(write, future)]
+        self.locker = threading.Lock()
+        self.is_started = False
+
+    def start(self):
+        with self.locker:
+            if self.is_started:
+                return
+
+            threading.Thread(target=self.run, name='db_writer', daemon=True).start()
+            self.is_started = True
+
+    # write(db) is called in transaction, future gets its result after commit
+    def submit(self, write) -> Future:
+        future = Future()
+        self.writes.put((write, future))
+        return future
+
+    def execute(self, sql, params=()) -> Future:
+        return self.submit(lambda db: db.execute(sql, params).rowcount)
+
+    def executemany(self, sql, seq_of_params) -> Future:
+        seq_of_params = list(seq_of_params)
+        return self.submit(lambda db: db.executemany(sql, seq_of_params).rowcount)
+
+    def get_batch(self):
+        batch = [self.writes.get()]
+        deadline = time.monotonic() + self.batch_delay
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.writes.get(timeout=timeout) if timeout > 0 else self.writes.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    # writes are never lost silently: if batch can't be committed, every caller gets the exception.
+    # Thread survives errors, broken connection is reopened for the next batch
+    def run(self):
+        db = None
+
+        while True:
+            batch = self.get_batch()
+            results = []  # [(future, result, exception)]
+            start_time = time.perf_counter()
+
+            try:
+                if db is None:
+                    db = self.connect()
+
+                db.execute("BEGIN IMMEDIATE")
+
+                for write, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+
+                    db.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, write(db), None))
+                        db.execute("RELEASE write")
+                    except Exception as e:
+                        db.execute("ROLLBACK TO write")
+                        db.execute("RELEASE write")
+                        results.append((future, None, e))
+
+                db.execute("COMMIT")
+            except Exception as e:
+                logger.error(f'Error while committing {len(batch)} writes: {e}')
+                db = self.rollback(db)
+
+                # nothing of the batch was saved
+                results = [(future, None, e) for _, future in batch if not future.done()]
+
+            commit_time.observe(time.perf_counter() - start_time)
+            batch_size.observe(len(batch))
+
+            for future, result, exception in results:
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
+
+    # returns connection which can be used for the next batch or None if it's broken
+    def rollback(self, db):
+        if db is None:
+            return None
+
+        try:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            return db
+        except Exception as e:
+            logger.error(f'Error while rolling back writes, connection will be reopened: {e}')
+            try:
+                db.close()
+            except Exception:
+                pass
+            return None
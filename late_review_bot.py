@@ -1,39 +1,46 @@
 import time
+import config
 import telebot
 import my_enums
+import tg_sender
+import webhook_server
 import my_db as db
-from log_writer import logger
+from log_writer import get_logger
 
-bot = telebot.TeleBot('your_tg_bot_token')
+logger = get_logger(__name__)
 
+# in webhook mode handlers are run by webhook_server workers, so bot doesn't need its own threads
+bot = telebot.TeleBot(config.get('telegram', {}).get('late_review_bot_token', 'your_tg_bot_token'),
+                      threaded=not webhook_server.is_enabled)
 
-# send messages to users
+
+# notifications are saved to outbox and sent in background within telegram limits
+sender = tg_sender.Sender(bot, 'late_review_bot', db.remove_late_review_chat, log_prefix='[late_review_bot] ')
+
+
+# send messages to users. msg_list: [(review_id, msg)]
 def send_msgs(msg_list, notif_type: my_enums.NotifType):
-    logger.info(f'[late_review_bot] start: send_msgs(), notif_type: {notif_type.value}')
+    logger.debug(f'[late_review_bot] start: send_msgs(), notif_type: {notif_type.value}')
     chat_list = db.get_late_review_chats(notif_type)
 
+    notifications = []
     for chat in chat_list:
-        for msg in msg_list:
-            try:
-                bot.send_message(chat, msg, parse_mode='html')
-                logger.info(f'[late_review_bot] msg sent to chat: {chat}')
-            except Exception as e:
-                if isinstance(e, telebot.apihelper.ApiTelegramException) and e.result_json['error_code'] == 403:
-                    logger.info(f"[late_review_bot] chat {chat}: user blocked bot (Error: {e.result_json['error_code']})")
-                    db.remove_late_review_chat(chat)
-                    break
-                else:
-                    logger.warning(f"[late_review_bot] Couldn't send msg to chat: {chat}. Error: {e}")
+        for review_id, msg in msg_list:
+            notifications.append((chat, review_id, notif_type.value, msg))
 
-            time.sleep(0.5)  # delay before send next message
+    if len(notifications) > 0:
+        db.enqueue_notifications(sender.bot_name, notifications)
+        sender.wake()
 
-    logger.info(f'[late_review_bot] end: send_msgs(), notif_type: {notif_type.value}')
+    logger.debug(f'[late_review_bot] end: send_msgs(), notif_type: {notif_type.value}')
 
 
 def bot_polling():
     while True:
         try:
             logger.info('[late_review_bot] thread_3: start bot.polling(none_stop=True)')
+            # webhook is removed if it was set before, otherwise telegram doesn't give updates by polling
+            bot.remove_webhook()
             bot.polling(none_stop=True)
         except Exception as e:
             logger.warning(f'[late_review_bot] thread_3: an error occurred during bot.polling(none_stop=True): {e}' + \
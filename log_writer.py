@@ -1,16 +1,75 @@
-import logging
-import datetime
 import os
+import sys
+import glob
+import datetime
+import queue
+import atexit
+import config
+import logging
+import logging.handlers
+
+logs_directory = 'logs'
+log_format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+# "logging" section of config.json
+settings = config.get('logging', {})
+level = settings.get('level', 'INFO')
+levels = settings.get('levels', {})  # {module name: level}, e.g. {"my_db": "DEBUG"}
+retention_days = settings.get('retention_days', 14)
+
+# every script writes its own file (logs/main.log), so processes don't rotate the same file
+script_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'log'
+
+
+# rotates log at midnight to logs/<script>_YYYY-mm-dd.log and keeps only retention_days files
+class DailyFileHandler(logging.handlers.TimedRotatingFileHandler):
+    def __init__(self, name):
+        self.name_prefix = os.path.join(logs_directory, name)
+        super().__init__(self.name_prefix + '.log', when='midnight', backupCount=retention_days, encoding='utf-8')
+        self.namer = self.get_rotated_name
+
+    # rotated file gets the date of its records: logs/main.log.2024-01-01 -> logs/main_2024-01-01.log
+    def get_rotated_name(self, default_name):
+        return f'{self.name_prefix}_{default_name.rsplit(".", 1)[-1]}.log'
 
-os.makedirs('logs', exist_ok=True)
+    def getFilesToDelete(self):
+        # names contain dates only, so sorted names are sorted by date too
+        files = sorted(glob.glob(f'{glob.escape(self.name_prefix)}_????-??-??.log'))
+        old_files = files[:max(0, len(files) - self.backupCount)]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s]: %(message)s',
-    handlers=[
-        logging.FileHandler('logs/log_{:%Y-%m-%d}.log'.format(datetime.datetime.now())),
-        logging.StreamHandler()
-    ]
-)
+        # files of versions without rotation (logs/log_YYYY-mm-dd.log) are removed by date in name
+        min_date = (datetime.date.today() - datetime.timedelta(days=self.backupCount)).isoformat()
+        for file in glob.glob(os.path.join(logs_directory, 'log_????-??-??.log')):
+            if file[-14:-4] < min_date and file not in old_files:
+                old_files.append(file)
+
+        return old_files
+
+
+os.makedirs(logs_directory, exist_ok=True)
+
+# records are put to queue by the caller and written to file and console by the listener thread,
+# so slow disk doesn't delay polling and sending
+log_queue = queue.SimpleQueue()
+formatter = logging.Formatter(log_format)
+
+file_handler = DailyFileHandler(script_name)
+file_handler.setFormatter(formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+
+listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)  # write records which are still in queue
 
 logger = logging.getLogger()
+logger.setLevel(level)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+for name, module_level in levels.items():
+    logging.getLogger(name).setLevel(module_level)
+
+
+# logger of module, its level can be changed in "levels" of config.json
+def get_logger(name):
+    return logging.getLogger(name)
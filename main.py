@@ -1,44 +1,137 @@
 import wb
 import time
+import config
+import metrics
 import datetime
 import my_enums
+import shop_registry
 import review_bot
 import late_review_bot
 import threading
+import webhook_server
 import my_db as db
-from log_writer import logger
+from log_writer import get_logger
+from poll_interval import AdaptiveInterval
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Shop_1
-OB_token = 'wildberries_token'
-# Shop_2
-KD_token = 'wildberries_token'
+logger = get_logger('main')
 
-broadcast_delay = 60  # seconds
+broadcast_tick = 1  # seconds, how often shops are checked for the next poll
+overdue_check_delay = 1  # seconds
+outbox_max_age = 7 * 24 * 60 * 60  # seconds, sent notifications are kept in outbox to avoid duplicates
 
+shops = shop_registry.load_shops()
+max_parallel_shops = config.get('max_parallel_shops', 8)  # shops which are polled at the same time
 
-def broadcast_loop():
-    while True:
-        broadcast_is_run(True)
-        logger.info('--- start broadcast_loop() ---')
+cycle_time = metrics.Histogram('broadcast_cycle_seconds', 'Duration of broadcast cycle, from the first poll to the last one')
+last_cycle_date = metrics.Gauge('broadcast_last_cycle_timestamp', 'Unix time when the last broadcast cycle finished')
+stage_time = metrics.Histogram('poll_stage_seconds', 'Duration of stage of shop poll: fetch, reviews, answers, enqueue')
+poll_interval = metrics.Gauge('poll_interval_seconds', 'Current poll interval of shop')
+failed_polls = metrics.Counter('failed_polls_total', 'Polls which ended without feedbacks snapshot')
+new_reviews_count = metrics.Counter('new_reviews_total', 'New reviews detected')
+new_answers_count = metrics.Counter('new_answers_total', 'New answers detected')
+overdue_reviews_count = metrics.Counter('overdue_reviews_total', 'Reviews without answer after deadline detected')
 
-        # check and send notification about new reviews
-        review_bot.send_msgs(wb.get_new_reviews(OB_token, my_enums.Shop.OB), my_enums.NotifType.REVIEWS)
-        review_bot.send_msgs(wb.get_new_reviews(KD_token, my_enums.Shop.KD), my_enums.NotifType.REVIEWS)
 
-        # check and send notification about new answers
-        review_bot.send_msgs(wb.get_new_answers(OB_token, my_enums.Shop.OB), my_enums.NotifType.ANSWERS)
-        review_bot.send_msgs(wb.get_new_answers(KD_token, my_enums.Shop.KD), my_enums.NotifType.ANSWERS)
-
-        # check and send notification about overdue answers
-        late_review_bot.send_msgs(wb.get_overdue_reviews(OB_token, my_enums.Shop.OB), my_enums.NotifType.ANSWERS)
-        late_review_bot.send_msgs(wb.get_overdue_reviews(KD_token, my_enums.Shop.KD), my_enums.NotifType.ANSWERS)
+def broadcast_loop():
+    # every shop is polled with its own interval. Shops are polled in parallel,
+    # so slow or unavailable shop doesn't delay notifications of others
+    next_poll_dates = {shop: 0 for shop in shops}
+    poll_intervals = {shop: AdaptiveInterval(shop.poll_interval, shop.min_poll_interval, shop.max_poll_interval)
+                      for shop in shops}
+    polling_shops = {}  # {future: shop}
+
+    with ThreadPoolExecutor(max_workers=max_parallel_shops, thread_name_prefix='shop') as executor:
+        while True:
+            cur_time = time.time()
+
+            for shop in shops:
+                if next_poll_dates[shop] <= cur_time:
+                    if len(polling_shops) == 0:
+                        cycle_start_time = time.perf_counter()
+                        broadcast_is_run(True)
+                        logger.info('--- start broadcast_loop() ---')
+
+                    polling_shops[executor.submit(poll_shop, shop)] = shop
+                    next_poll_dates[shop] = float('inf')  # it will be set when poll is finished
+
+            done, _ = wait(polling_shops, timeout=broadcast_tick, return_when=FIRST_COMPLETED)
+            if len(polling_shops) == 0:
+                time.sleep(broadcast_tick)
+
+            for future in done:
+                shop = polling_shops.pop(future)
+
+                try:
+                    activity = future.result()
+                except Exception as e:
+                    logger.error(f'Error while polling shop {shop.name}: {e}')
+                    activity = None
+
+                if activity is None:
+                    failed_polls.inc(shop=shop.code)
+
+                interval = poll_intervals[shop].next(activity)
+                next_poll_dates[shop] = time.time() + interval
+                poll_interval.set(interval, shop=shop.code)
+
+            if len(done) > 0 and len(polling_shops) == 0:
+                db.update_broadcast_last_check_date(int(datetime.datetime.now().timestamp()))
+                cycle_time.observe(time.perf_counter() - cycle_start_time)
+                last_cycle_date.set(int(time.time()))
+                broadcast_is_run(False)
+                logger.info('--- end broadcast_loop() ---')
+
+
+# returns number of new reviews and answers or None if feedbacks weren't received
+def poll_shop(shop: shop_registry.Shop):
+    # one request per shop, the snapshot is shared between all checks below
+    with stage_time.time(shop=shop.code, stage='fetch'):
+        snapshot = wb.get_feedbacks_snapshot(shop)
+    if snapshot is None:
+        return None
+
+    # check and send notification about new reviews
+    with stage_time.time(shop=shop.code, stage='reviews'):
+        new_reviews = wb.get_new_reviews(snapshot, shop)
+    with stage_time.time(shop=shop.code, stage='enqueue'):
+        review_bot.send_msgs(new_reviews, my_enums.NotifType.REVIEWS)
+    # state is saved after notifications are in outbox, so they aren't lost if bot stops in between
+    wb.save_new_reviews(new_reviews, snapshot, shop)
+
+    # check and send notification about new answers
+    with stage_time.time(shop=shop.code, stage='answers'):
+        new_answers, resolved_ids = wb.get_new_answers(snapshot, shop)
+    with stage_time.time(shop=shop.code, stage='enqueue'):
+        review_bot.send_msgs(new_answers, my_enums.NotifType.ANSWERS)
+    wb.save_new_answers(resolved_ids, snapshot, shop)
+
+    new_reviews_count.inc(len(new_reviews), shop=shop.code)
+    new_answers_count.inc(len(new_answers), shop=shop.code)
+
+    return len(new_reviews) + len(new_answers)
+
+
+# check and send notification about overdue answers as soon as review deadline comes
+def overdue_loop():
+    while True:
+        overdue_reviews = []
+        try:
+            overdue_reviews = wb.get_overdue_reviews()
+            if len(overdue_reviews) > 0:
+                late_review_bot.send_msgs([(review_id, msg) for _, review_id, msg in overdue_reviews],
+                                          my_enums.NotifType.ANSWERS)
+                overdue_reviews_count.inc(len(overdue_reviews))
 
-        cur_time = int(datetime.datetime.now().timestamp())
-        db.update_broadcast_last_check_date(cur_time)
-        broadcast_is_run(False)
-        logger.info('--- end broadcast_loop() ---')
+                # notifications are already saved to outbox, so they will be sent even after restart
+                for _, review_id, _ in overdue_reviews:
+                    db.make_unanswered_review_dirty(review_id)
+        except Exception as e:
+            logger.error(f'Error in overdue_loop(): {e}')
+            # due reviews were removed from scheduler, outbox doesn't enqueue already enqueued ones again
+            wb.reschedule_overdue_reviews([(shop, review_id) for shop, review_id, _ in overdue_reviews])
 
-        time.sleep(broadcast_delay)
+        time.sleep(overdue_check_delay)
 
 
 def broadcast_is_run(current_status: bool):
@@ -51,16 +144,32 @@ def broadcast_is_run(current_status: bool):
 
 if __name__ == '__main__':
     # open or create new db
-    db.init()
+    db.init(shops)
+    wb.init_overdue_reviews(shops)
+    db.remove_old_notifications(outbox_max_age)
+    metrics.start()
+
+    # send notifications which weren't sent before restart
+    review_bot.sender.start()
+    late_review_bot.sender.start()
 
     # Запуск потока для рассылки уведомлений
     broadcast_thread = threading.Thread(target=broadcast_loop)
     broadcast_thread.start()
 
-    # Запуск потока для реакций на команды пользователя (review_bot)
-    reaction_thread = threading.Thread(target=review_bot.bot_polling)
-    reaction_thread.start()
-
-    # Запуск потока для реакций на команды пользователя (late_review_bot)
-    reaction_thread = threading.Thread(target=late_review_bot.bot_polling)
-    reaction_thread.start()
+    # Запуск потока для уведомлений о просроченных ответах
+    overdue_thread = threading.Thread(target=overdue_loop)
+    overdue_thread.start()
+
+    if webhook_server.is_enabled:
+        # one server receives updates of both bots
+        webhook_server.start({review_bot.sender.bot_name: review_bot.bot,
+                              late_review_bot.sender.bot_name: late_review_bot.bot})
+    else:
+        # Запуск потока для реакций на команды пользователя (review_bot)
+        reaction_thread = threading.Thread(target=review_bot.bot_polling)
+        reaction_thread.start()
+
+        # Запуск потока для реакций на команды пользователя (late_review_bot)
+        reaction_thread = threading.Thread(target=late_review_bot.bot_polling)
+        reaction_thread.start()
@@ -0,0 +1,193 @@
+import os
+import time
+import config
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from log_writer import get_logger
+
+logger = get_logger(__name__)
+
+# settings from "metrics" section of config.json
+settings = config.get('metrics', {})
+host = settings.get('host', '127.0.0.1')
+port = settings.get('port')  # metrics are served on http://host:port/metrics, not served if not set
+file_name = settings.get('file')  # metrics are written to this file, not written if not set
+file_interval = settings.get('file_interval', 15)  # seconds
+
+# seconds, upper bounds of histogram buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = []  # all created metrics in order of creation
+locker = threading.Lock()
+
+
+# metric values are kept for every combination of labels: metric.inc(shop='OB')
+class Metric:
+    type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.locker = threading.Lock()
+        self.values = {}  # {((label, value), ...): value}
+
+        with locker:
+            registry.append(self)
+
+    def get_lines(self):
+        with self.locker:
+            return [f'{self.name}{format_labels(labels)} {format_value(value)}' for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.locker:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.locker:
+            self.values[key] = value
+
+
+# distribution of durations, alerts on cycle time are made by its buckets
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=default_buckets):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.locker:
+            if key not in self.values:
+                # [count of every bucket, sum, count]
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+
+            bucket_counts, _, _ = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    # with histogram.time(shop='OB'): ... observes duration of the block
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def get_lines(self):
+        lines = []
+
+        with self.locker:
+            for labels, (bucket_counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {bucket_count}')
+
+                lines.append(f'{self.name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start_time, **self.labels)
+        return False
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    formatted = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append(f'{label}="{value}"')
+
+    return '{' + ','.join(formatted) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# all metrics in prometheus text format
+def get_text():
+    with locker:
+        metrics = list(registry)
+
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.get_lines())
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = get_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # requests of prometheus are not logged
+    def log_message(self, format, *args):
+        pass
+
+
+def write_file_loop():
+    while True:
+        try:
+            # file is replaced at once, so reader never gets half-written metrics
+            with open(file_name + '.tmp', 'w', encoding='utf-8') as file:
+                file.write(get_text())
+            os.replace(file_name + '.tmp', file_name)
+        except Exception as e:
+            logger.warning(f'Error while writing metrics to {file_name}: {e}')
+
+        time.sleep(file_interval)
+
+
+# starts serving metrics in background according to config.json. Metrics are optional,
+# so bot keeps working if they can't be served (e.g. port is busy)
+def start():
+    if port is not None:
+        try:
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            logger.error(f'Metrics are not served, error while binding {host}:{port}: {e}')
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+            logger.info(f'Metrics are served on http://{host}:{port}/metrics')
+
+    if file_name is not None:
+        threading.Thread(target=write_file_loop, name='metrics_file', daemon=True).start()
+        logger.info(f'Metrics are written to {file_name}')
@@ -0,0 +1,199 @@
+import sqlite3
+import my_enums
+from log_writer import get_logger
+
+logger = get_logger(__name__)
+
+
+# schema changes of db. Number of applied steps is kept in PRAGMA user_version, so every step is applied once
+# and old db is upgraded in place. New step is added to the end of steps list, applied steps are never changed
+
+
+# version 1: tables of versions without migrations. Old db already has them, except columns added later
+def create_tables(c: sqlite3.Cursor):
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS chats(
+            id INTEGER UNIQUE,
+            answer_notif INTEGER,
+            review_notif INTEGER,
+            develop_notif INTEGER
+            )
+            """)
+
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS late_review_chats(
+            chat_id INTEGER UNIQUE,
+            answer_notif INTEGER
+            )
+            """)
+
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS unanswered_reviews(
+            shop text,
+            review_id text UNIQUE,
+            ntf_already_snt INTEGER
+            )
+            """)
+
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS past_review_ids(
+            shop text,
+            review_id text UNIQUE
+            )
+            """)
+
+    # created_date was added later, so old db doesn't have it
+    c.execute("PRAGMA table_info(unanswered_reviews)")
+    if 'created_date' not in [column[1] for column in c.fetchall()]:
+        c.execute("ALTER TABLE unanswered_reviews ADD COLUMN created_date INTEGER")
+
+    # dates represent seconds (Unix TimeStamp)
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS dates(
+            name text UNIQUE,
+            last_check_date INTEGER DEFAULT 0
+            )
+            """)
+
+    # notifications which are waiting for sending. Delivered ones are kept for a while,
+    # so the same notification isn't sent twice (see UNIQUE)
+    c.execute("""
+            CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot text,
+            chat_id INTEGER,
+            review_id text,
+            kind text,
+            msg text,
+            created_date INTEGER,
+            attempts INTEGER DEFAULT 0,
+            delivered_date INTEGER,
+            UNIQUE(bot, chat_id, review_id, kind)
+            )
+            """)
+
+    c.execute("""
+            CREATE INDEX IF NOT EXISTS outbox_pending ON outbox(bot, id) WHERE delivered_date IS NULL
+            """)
+
+
+# version 2: reviews are stored with text keys and indexed by shop, dates of shops are keyed by (shop, notif_type)
+# instead of names like 'KD_review_notif'
+def normalize_keys(c: sqlite3.Cursor):
+    # sqlite can't change columns, so tables are copied
+    c.execute("""
+            CREATE TABLE unanswered_reviews_new(
+            shop TEXT NOT NULL,
+            review_id TEXT PRIMARY KEY,
+            ntf_already_snt INTEGER NOT NULL DEFAULT 0,
+            created_date INTEGER
+            )
+            """)
+
+    c.execute("""
+            INSERT OR IGNORE INTO unanswered_reviews_new
+            SELECT CAST(shop AS TEXT), CAST(review_id AS TEXT), COALESCE(ntf_already_snt, 0), created_date
+            FROM unanswered_reviews WHERE shop IS NOT NULL AND review_id IS NOT NULL
+            """)
+
+    c.execute("DROP TABLE unanswered_reviews")
+    c.execute("ALTER TABLE unanswered_reviews_new RENAME TO unanswered_reviews")
+    c.execute("CREATE INDEX unanswered_reviews_shop ON unanswered_reviews(shop, review_id)")
+    c.execute("CREATE INDEX unanswered_reviews_ntf ON unanswered_reviews(shop, ntf_already_snt)")
+
+    c.execute("""
+            CREATE TABLE past_review_ids_new(
+            shop TEXT NOT NULL,
+            review_id TEXT PRIMARY KEY
+            )
+            """)
+
+    c.execute("""
+            INSERT OR IGNORE INTO past_review_ids_new
+            SELECT CAST(shop AS TEXT), CAST(review_id AS TEXT)
+            FROM past_review_ids WHERE shop IS NOT NULL AND review_id IS NOT NULL
+            """)
+
+    c.execute("DROP TABLE past_review_ids")
+    c.execute("ALTER TABLE past_review_ids_new RENAME TO past_review_ids")
+    c.execute("CREATE INDEX past_review_ids_shop ON past_review_ids(shop, review_id)")
+
+    c.execute("""
+            CREATE TABLE shop_dates(
+            shop TEXT NOT NULL,
+            notif_type TEXT NOT NULL,
+            last_check_date INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(shop, notif_type)
+            ) WITHOUT ROWID
+            """)
+
+    # shop code can contain '_', so name is split by known suffix
+    c.execute("SELECT name, last_check_date FROM dates")
+    for name, last_check_date in c.fetchall():
+        for notif_type in [my_enums.NotifType.REVIEWS, my_enums.NotifType.ANSWERS]:
+            suffix = '_' + notif_type.value
+            if name.endswith(suffix):
+                c.execute("""
+                        INSERT INTO shop_dates VALUES(?, ?, ?)
+                        """, (name[:-len(suffix)], notif_type.value, last_check_date or 0))
+                c.execute("DELETE FROM dates WHERE name = ?", (name,))
+
+
+# version 3: ids of reviews which were already notified are kept for a time window instead of the last batch only.
+# Rows are only inserted and removed after the window, so the table isn't rewritten every cycle
+def add_seen_review_ids(c: sqlite3.Cursor):
+    c.execute("""
+            CREATE TABLE seen_review_ids(
+            shop TEXT NOT NULL,
+            review_id TEXT NOT NULL,
+            seen_date INTEGER NOT NULL,
+            PRIMARY KEY(shop, review_id)
+            ) WITHOUT ROWID
+            """)
+
+    c.execute("CREATE INDEX seen_review_ids_date ON seen_review_ids(seen_date)")
+
+    c.execute("""
+            INSERT OR IGNORE INTO seen_review_ids
+            SELECT shop, review_id, CAST(strftime('%s', 'now') AS INTEGER) FROM past_review_ids
+            """)
+
+    c.execute("DROP TABLE past_review_ids")
+
+
+# version 4: cache of product cards by nmId, so notifications show product when feedback doesn't have it.
+# update_date is the last time when product was received from WB
+def add_products(c: sqlite3.Cursor):
+    c.execute("""
+            CREATE TABLE products(
+            nm_id INTEGER PRIMARY KEY,
+            name TEXT,
+            supplier_article TEXT,
+            update_date INTEGER NOT NULL
+            )
+            """)
+
+    c.execute("CREATE INDEX products_date ON products(update_date)")
+
+
+steps = [create_tables, normalize_keys, add_seen_review_ids, add_products]
+
+
+# applies steps which weren't applied to db yet. Every step is applied in its own transaction
+def migrate(db: sqlite3.Connection):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+
+    if version > len(steps):
+        raise RuntimeError(f'DB version {version} is newer than the latest migration {len(steps)}')
+
+    for number, step in enumerate(steps[version:], start=version + 1):
+        logger.info(f'migrate db to version {number}: {step.__name__}()')
+
+        db.execute("BEGIN")
+        try:
+            step(db.cursor())
+            db.execute(f"PRAGMA user_version = {number}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
@@ -0,0 +1,51 @@
+import datetime
+from collections import namedtuple
+
+# attributes of product card, they are the same in all feedbacks of nmId
+Product = namedtuple('Product', ['name', 'supplier_article'])
+
+
+# feedback from WB API with only fields which are used by bot. It's created once per response,
+# so raw json dicts of the page can be freed right after parsing
+class Feedback:
+    __slots__ = ('id', 'text', 'valuation', 'created_date', 'brand', 'nm_id', 'product_name', 'supplier_article',
+                 'size', 'answer')
+
+    def __init__(self, id, text, valuation, created_date, brand, nm_id, product_name, supplier_article, size,
+                 answer):
+        self.id = id
+        self.text = text
+        self.valuation = valuation
+        self.created_date = created_date  # Unix TimeStamp
+        self.brand = brand
+        self.nm_id = nm_id
+        # WB doesn't always fill these fields, so they can be None
+        self.product_name = product_name
+        self.supplier_article = supplier_article
+        self.size = size  # size of the bought item, not of the card
+        self.answer = answer  # answer text or None if there is no answer
+
+    @staticmethod
+    def from_json(feedback):
+        answer = feedback.get('answer')
+        product_details = feedback['productDetails']
+
+        return Feedback(feedback['id'],
+                        feedback['text'],
+                        feedback['productValuation'],
+                        convert_sz_date_to_timestamp(feedback['createdDate']),
+                        product_details['brandName'],
+                        product_details['nmId'],
+                        product_details.get('productName') or None,
+                        product_details.get('supplierArticle') or None,
+                        product_details.get('size') or None,
+                        answer['text'] if answer is not None else None)
+
+    def __repr__(self):
+        return f'Feedback({self.id})'
+
+
+# WB dates are in UTC: '2024-01-01T10:00:00Z'
+def convert_sz_date_to_timestamp(sz_date_string):
+    return int(datetime.datetime.strptime(sz_date_string, '%Y-%m-%dT%H:%M:%SZ')
+               .replace(tzinfo=datetime.timezone.utc).timestamp())
@@ -1,460 +1,637 @@
 import os
+import time
 import sqlite3
+import metrics
+import urllib.parse
+import migrations
 import my_enums
+import config
+import shop_registry
 import threading
-from log_writer import logger
-
-locker = threading.RLock()
-db_name = 'sqlite_db.db'
+from log_writer import get_logger
+from seen_ids import SeenIds
+from models import Product
+from product_cache import ProductCache
+from db_writer import DbWriter
 
+logger = get_logger(__name__)
 
-def init():
-    with locker:
+db_name = 'sqlite_db.db'
+local = threading.local()  # read-only connection of thread
+
+# all writes go through one writer thread, it commits writes of all threads together.
+# Lambda is used, so connect() is looked up when writer starts
+db_settings = config.get('db', {})
+writer = DbWriter(lambda: connect(), db_settings.get('batch_delay', 0.005), db_settings.get('max_batch', 200))
+# bot commands don't wait for writer longer than this, TimeoutError is raised to handler
+write_timeout = db_settings.get('write_timeout', 30)  # seconds
+
+# serialize changes of in-memory copies below with their writes. Chats have their own locker,
+# so bot commands don't wait for sync of reviews
+reviews_locker = threading.RLock()
+chats_locker = threading.RLock()
+
+# in-memory copy of unanswered_reviews table, it's loaded in init() and changed together with the table
+# {shop: {review_id: [ntf_already_snt, created_date]}}
+unanswered_index = {}
+
+# ids of reviews which were already notified, so duplicates from WB are skipped. Key is (shop, review_id)
+seen_review_ttl = config.get('seen_review_ttl', 7 * 24 * 60 * 60)  # seconds
+seen_review_max_size = config.get('seen_review_max_size', 200000)
+seen_reviews = SeenIds(seen_review_ttl, seen_review_max_size)
+seen_reviews_prune_delay = 60 * 60  # seconds, how often expired ids are removed from db
+seen_reviews_prune_date = 0
+
+# products of feedbacks by nmId, the most used ones are in memory and all of them are in products table
+product_ttl = config.get('product_cache_ttl', 30 * 24 * 60 * 60)  # seconds
+product_max_size = config.get('product_cache_max_size', 50000)
+products = ProductCache(product_ttl, product_max_size)
+
+# in-memory copies of chats and late_review_chats tables, they are loaded in init() and changed together with tables.
+# {chat_id: {notif_type value: 0 or 1}}
+chats_index = {}
+late_review_chats_index = {}
+# chats with turned on notification, so fan-out doesn't read db: {notif_type value: set of chat_id}
+subscriptions = {}
+late_review_subscriptions = {}
+
+sync_time = metrics.Histogram('db_sync_seconds', 'Duration of transaction which syncs table with the latest snapshot')
+
+
+# read-only connection doesn't take write lock, so in WAL mode readers never wait for writer.
+# Write connection is in autocommit mode, transactions are begun explicitly
+def connect(read_only=False):
+    if read_only:
+        db = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(db_name))}?mode=ro', uri=True,
+                             timeout=30, cached_statements=256)
+    else:
+        db = sqlite3.connect(db_name, timeout=30, cached_statements=256, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+
+    return db
+
+
+# long-lived read-only connection per thread. Statements are parameterized, so sqlite3 caches them compiled
+def get_connection():
+    db = getattr(local, 'db', None)
+
+    if db is None:
+        db = connect(read_only=True)
+        local.db = db
+
+    return db
+
+
+def init(shops):
+    with reviews_locker, chats_locker:
         logger.info('init db...')
 
         is_db_existed = os.path.exists(db_name)
         logger.info(f'DB already existed: {is_db_existed}')
 
-        db = sqlite3.connect(db_name)
+        # tables are prepared before writer is started
+        db = connect()
         c = db.cursor()
 
-        c.execute("""
-                CREATE TABLE IF NOT EXISTS chats(
-                id INTEGER UNIQUE,
-                answer_notif INTEGER,
-                review_notif INTEGER,
-                develop_notif INTEGER
-                )
-                """)
+        # create or upgrade tables
+        migrations.migrate(db)
 
-        c.execute("""
-                CREATE TABLE IF NOT EXISTS late_review_chats(
-                chat_id INTEGER UNIQUE,
-                answer_notif INTEGER
-                )
-                """)
+        c.execute("BEGIN")
 
-        c.execute("""
-                CREATE TABLE IF NOT EXISTS unanswered_reviews(
-                shop text,
-                review_id text UNIQUE,
-                ntf_already_snt INTEGER
-                )
-                """)
-
-        c.execute("""
-                CREATE TABLE IF NOT EXISTS past_review_ids(
-                shop text,
-                review_id text UNIQUE
-                )
-                """)
+        # create last_check_date for shops which aren't in db yet
+        c.execute("""INSERT OR IGNORE INTO dates VALUES('broadcast_loop', 0)""")
+        for shop in shops:
+            for notif_type in [my_enums.NotifType.REVIEWS, my_enums.NotifType.ANSWERS]:
+                c.execute("""INSERT OR IGNORE INTO shop_dates VALUES(?, ?, 0)""", (shop.code, notif_type.value))
 
-        # dates represent seconds (Unix TimeStamp)
-        c.execute("""
-                CREATE TABLE IF NOT EXISTS dates(
-                name text UNIQUE,
-                last_check_date INTEGER DEFAULT 0
-                )
-                """)
-
-        # create last_check_date for shops if db didn't exist
-        if not is_db_existed:
-            c.execute("""INSERT INTO dates VALUES('KD_review_notif', 0)""")
-            c.execute("""INSERT INTO dates VALUES('OB_review_notif', 0)""")
-            c.execute("""INSERT INTO dates VALUES('broadcast_loop', 0)""")
+        c.execute("DELETE FROM seen_review_ids WHERE seen_date <= ?", (int(time.time()) - seen_review_ttl,))
+        c.execute("DELETE FROM products WHERE update_date <= ?", (int(time.time()) - product_ttl,))
 
         db.commit()
         db.close()
 
-        logger.info('db was inited and closed')
+        writer.start()
+        c = get_connection().cursor()
 
+        # load unanswered reviews to memory
+        unanswered_index.clear()
+        c.execute("SELECT shop, review_id, ntf_already_snt, created_date FROM unanswered_reviews")
+        for shop, review_id, ntf_already_snt, created_date in c.fetchall():
+            unanswered_index.setdefault(shop, {})[review_id] = [ntf_already_snt, created_date]
 
-def is_chat_exists(chat_id):
-    logger.info('start: is_chat_exist()')
+        # load seen reviews to memory, expired ones were removed above
+        seen_reviews.clear()
+        c.execute("SELECT shop, review_id, seen_date FROM seen_review_ids ORDER BY seen_date")
+        for shop, review_id, seen_date in c.fetchall():
+            seen_reviews.add((shop, review_id), seen_date)
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+        # load the latest products to memory, others are read from db when they are needed
+        products.clear()
+        c.execute("""
+                SELECT nm_id, name, supplier_article, update_date FROM
+                (SELECT * FROM products ORDER BY update_date DESC LIMIT ?) ORDER BY update_date
+                """, (product_max_size,))
+        for nm_id, name, supplier_article, update_date in c.fetchall():
+            products.put(nm_id, Product(name, supplier_article), update_date)
+
+        # load chats to memory
+        chats_index.clear()
+        subscriptions.clear()
+        c.execute("SELECT id, answer_notif, review_notif, develop_notif FROM chats")
+        for chat_id, answer_notif, review_notif, develop_notif in c.fetchall():
+            index_chat(chats_index, subscriptions, chat_id, {my_enums.NotifType.ANSWERS.value: answer_notif,
+                                                              my_enums.NotifType.REVIEWS.value: review_notif,
+                                                              my_enums.NotifType.DEVELOP.value: develop_notif})
+
+        late_review_chats_index.clear()
+        late_review_subscriptions.clear()
+        c.execute("SELECT chat_id, answer_notif FROM late_review_chats")
+        for chat_id, answer_notif in c.fetchall():
+            index_chat(late_review_chats_index, late_review_subscriptions, chat_id,
+                       {my_enums.NotifType.ANSWERS.value: answer_notif})
+
+        logger.info('db was inited')
+
+
+# put chat settings {notif_type value: 0 or 1} to index and subscriptions. Call with chats_locker
+def index_chat(index, chat_subscriptions, chat_id, settings):
+    index[chat_id] = settings
+
+    for notif_type_value, notif_value in settings.items():
+        if notif_value == 1:
+            chat_subscriptions.setdefault(notif_type_value, set()).add(chat_id)
+        else:
+            chat_subscriptions.get(notif_type_value, set()).discard(chat_id)
 
-        c.execute(f"SELECT id FROM chats WHERE id = {chat_id}")
-        existing_record = c.fetchone()
-        db.close()
 
-        if existing_record:
-            logger.info('end: is_chat_exist() with True')
-            return True
-        else:
-            logger.info('end: is_chat_exist() with False')
-            return False
+def unindex_chat(index, chat_subscriptions, chat_id):
+    index.pop(chat_id, None)
+
+    for chats in chat_subscriptions.values():
+        chats.discard(chat_id)
+
+
+def is_chat_exists(chat_id):
+    logger.debug('start: is_chat_exist()')
+
+    with chats_locker:
+        is_existed = chat_id in chats_index
+
+    if is_existed:
+        logger.debug('end: is_chat_exist() with True')
+        return True
+    else:
+        logger.debug('end: is_chat_exist() with False')
+        return False
 
 
 def add_chat(chat_id, answer_notif=0, review_notif=0, develop_notif=0):
-    logger.info('start: add_chat()')
+    logger.debug('start: add_chat()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        writer.execute("""
+                INSERT INTO chats VALUES(?, ?, ?, ?)
+                """, (chat_id, answer_notif, review_notif, develop_notif)).result(timeout=write_timeout)
 
-        c.execute(f"""
-                INSERT INTO chats VALUES({chat_id}, {answer_notif}, {review_notif}, {develop_notif})
-                """)
-        db.commit()
-        db.close()
+        index_chat(chats_index, subscriptions, chat_id, {my_enums.NotifType.ANSWERS.value: answer_notif,
+                                                          my_enums.NotifType.REVIEWS.value: review_notif,
+                                                          my_enums.NotifType.DEVELOP.value: develop_notif})
 
         logger.info(f'chat was added: {chat_id}')
-        logger.info('end: add_chat()')
+        logger.debug('end: add_chat()')
 
 
 def remove_chat(chat_id):
-    logger.info('start: remove_chat()')
+    logger.debug('start: remove_chat()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        writer.execute("""
+                DELETE FROM chats WHERE id = ?
+                """, (chat_id,)).result(timeout=write_timeout)
 
-        c.execute(f"""
-                DELETE FROM chats WHERE id = {chat_id}
-                """)
-        db.commit()
-        db.close()
+        unindex_chat(chats_index, subscriptions, chat_id)
 
         logger.info(f'chat was deleted: {chat_id}')
-        logger.info('end: remove_chat()')
+        logger.debug('end: remove_chat()')
 
 
 # get chats id where special notification turn on
 def get_chats(notif_type: my_enums.NotifType):
-    logger.info('start: get_chats()')
-
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
-
-        c.execute(f"""
-                SELECT id FROM chats WHERE {notif_type.value} = 1 
-                """)
-
-        chat_list = []
-
-        for row in c.fetchall():
-            chat_list.append(row[0])
+    logger.debug('start: get_chats()')
 
-        db.close()
-        logger.info('end: get_chats()')
-        return chat_list
+    with chats_locker:
+        chat_list = list(subscriptions.get(notif_type.value, ()))
 
+    logger.debug('end: get_chats()')
+    return chat_list
 
-def get_last_check_date(shop: my_enums.Shop, notif_type: my_enums.NotifType):
-    logger.info('start: get_last_check_date()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+def get_last_check_date(shop: shop_registry.Shop, notif_type: my_enums.NotifType):
+    logger.debug('start: get_last_check_date()')
 
-        c.execute(f"""
-                SELECT last_check_date FROM dates WHERE name = '{shop.value + '_' + notif_type.value}'
-                """)
+    c = get_connection().cursor()
 
-        last_check_date = c.fetchone()[0]
+    c.execute("""
+            SELECT last_check_date FROM shop_dates WHERE shop = ? AND notif_type = ?
+            """, (shop.code, notif_type.value))
 
-        db.close()
-        logger.info('end: get_last_check_date()')
-        return last_check_date
+    last_check_date = c.fetchone()[0]
 
+    logger.debug('end: get_last_check_date()')
+    return last_check_date
 
-def update_last_check_date(shop: my_enums.Shop, notif_type: my_enums.NotifType, cur_time: int):
-    logger.info('start: update_last_check_date()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+def update_last_check_date(shop: shop_registry.Shop, notif_type: my_enums.NotifType, cur_time: int):
+    logger.debug('start: update_last_check_date()')
 
-        c.execute(f"""
-                UPDATE dates SET last_check_date = {cur_time} WHERE name = '{shop.value + '_' + notif_type.value}'
-                """)
+    writer.execute("""
+            UPDATE shop_dates SET last_check_date = ? WHERE shop = ? AND notif_type = ?
+            """, (cur_time, shop.code, notif_type.value)).result()
 
-        db.commit()
-        db.close()
-        logger.info('end update_last_check_date()')
+    logger.debug('end: update_last_check_date()')
 
 
 def update_broadcast_last_check_date(cur_time: int):
-    logger.info('start: update_broadcast_last_check_date()')
+    logger.debug('start: update_broadcast_last_check_date()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    writer.execute("""
+            UPDATE dates SET last_check_date = ? WHERE name = 'broadcast_loop'
+            """, (cur_time,)).result()
 
-        c.execute(f"""
-                UPDATE dates SET last_check_date = {cur_time} WHERE name = 'broadcast_loop'
-                """)
-
-        db.commit()
-        db.close()
-        logger.info('end: update_broadcast_last_check_date()')
+    logger.debug('end: update_broadcast_last_check_date()')
 
 
 def get_broadcast_last_check_date():
-    logger.info('start: get_broadcast_last_check_date()')
+    logger.debug('start: get_broadcast_last_check_date()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    c = get_connection().cursor()
 
-        c.execute(f"""
-                SELECT last_check_date FROM dates WHERE name = 'broadcast_loop'
-                """)
+    c.execute("""
+            SELECT last_check_date FROM dates WHERE name = 'broadcast_loop'
+            """)
 
-        last_check_date = c.fetchone()[0]
-        db.close()
+    last_check_date = c.fetchone()[0]
 
-        logger.info('end: get_broadcast_last_check_date()')
-        return last_check_date
+    logger.debug('end: get_broadcast_last_check_date()')
+    return last_check_date
 
 
 # invert chat notification value (0 will 1, 1 will 0)
 def tune_chat(chat_id, notif_type: my_enums.NotifType):
-    logger.info('start: tune_chat()')
+    logger.debug('start: tune_chat()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        settings = dict(chats_index[chat_id])
+        new_notif_value = 0 if settings[notif_type.value] == 1 else 1
 
-        c.execute(f"""
-                SELECT {notif_type.value} FROM chats WHERE id = {chat_id}
-                """)
+        # column name can't be a parameter, but it's taken from enum, not from user input
+        writer.execute(f"""
+                UPDATE chats SET {notif_type.value} = ? WHERE id = ?
+                """, (new_notif_value, chat_id)).result(timeout=write_timeout)
 
-        notif_value = c.fetchone()[0]  # get notif value (it's the first value in row)
+        settings[notif_type.value] = new_notif_value
+        index_chat(chats_index, subscriptions, chat_id, settings)
 
         # возвращает значение, которое зависит от того включили или отключили уведомление
-        if notif_value == 1:
-            c.execute(f"""
-                    UPDATE chats SET {notif_type.value} = 0 WHERE id = {chat_id}
-                    """)
+        logger.debug(f'end: tune_chat() with {new_notif_value == 1}')
+        return new_notif_value == 1
 
-            db.commit()
-            db.close()
 
-            logger.info('end: tune_chat() with False')
-            return False
-        else:
-            c.execute(f"""
-                    UPDATE chats SET {notif_type.value} = 1 WHERE id = {chat_id}
-                    """)
+def get_unanswered_ids(shop: shop_registry.Shop):
+    logger.debug('start: get_unanswered_ids()')
 
-            db.commit()
-            db.close()
+    with reviews_locker:
+        unanswered_ids = set(unanswered_index.get(shop.code, {}))
 
-            logger.info('end: tune_chat() with True')
-            return True
+    logger.debug('end: get_unanswered_ids()')
+    return unanswered_ids
 
 
-def get_unanswered_ids(shop: my_enums.Shop):
-    logger.info('start: get_unanswered_ids()')
+# returns {review_id: (ntf_already_snt, created_date)}
+def get_unanswered_reviews(shop: shop_registry.Shop):
+    logger.debug('start: get_unanswered_reviews()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with reviews_locker:
+        reviews = {review_id: tuple(review) for review_id, review in unanswered_index.get(shop.code, {}).items()}
 
-        c.execute(f"""
-                SELECT review_id FROM unanswered_reviews WHERE shop = '{shop.value}'
-                """)
+    logger.debug('end: get_unanswered_reviews()')
+    return reviews
 
-        unanswered_ids = []
-        for review_id in c.fetchall():
-            unanswered_ids.append(review_id[0])
 
-        db.close()
-        logger.info('end: get_unanswered_ids()')
-        return unanswered_ids
+def get_unanswered_review_ntf_status(review_id):
+    logger.debug('start: get_unanswered_review_ntf_status()')
 
+    with reviews_locker:
+        for reviews in unanswered_index.values():
+            if review_id in reviews:
+                logger.debug('end: get_unanswered_review_ntf_status()')
+                return reviews[review_id][0]
 
-def get_unanswered_review_ntf_status(review_id):
-    logger.info('start: get_unanswered_review_ntf_status()')
+    logger.debug('end: get_unanswered_review_ntf_status() with None')
+    return None
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
 
-        c.execute(f"""
-                SELECT ntf_already_snt FROM unanswered_reviews WHERE review_id = '{review_id}'
-                """)
+def make_unanswered_review_dirty(review_id):
+    logger.debug('start: make_unanswered_review_dirty()')
 
-        status = c.fetchall()
-        db.close()
-        logger.info('end: get_unanswered_review_ntf_status()')
-        return status[0][0]
+    with reviews_locker:
+        writer.execute("""
+                UPDATE unanswered_reviews SET ntf_already_snt = 1 WHERE review_id = ?
+                """, (review_id,)).result()
 
+        for reviews in unanswered_index.values():
+            if review_id in reviews:
+                reviews[review_id][0] = 1
 
-def make_unanswered_review_dirty(review_id):
-    logger.info('start: make_unanswered_review_dirty()')
+        logger.debug('end: make_unanswered_review_dirty()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
 
-        c.execute(f"""
-                UPDATE unanswered_reviews SET ntf_already_snt = 1 WHERE review_id = '{review_id}'
-                """)
+def remove_unanswered_review(review_id):
+    logger.debug('start: remove_unanswered_review()')
 
-        db.commit()
-        db.close()
-        logger.info('end: make_unanswered_review_dirty()')
+    with reviews_locker:
+        writer.execute("""
+                DELETE FROM unanswered_reviews WHERE review_id = ?
+                """, (review_id,)).result()
 
+        for reviews in unanswered_index.values():
+            reviews.pop(review_id, None)
 
-def add_unanswered_review(review_id, shop: my_enums.Shop):
-    logger.info('start: add_unanswered_review()')
+        logger.debug('end: remove_unanswered_review()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
 
-        c.execute(f"""
-                INSERT INTO unanswered_reviews VALUES('{shop.value}', '{review_id}', 0)
-                """)
+# add new reviews of {review_id: created_date} to shop's unanswered reviews in one transaction.
+# Returns (added ids, {gone id: created_date}). Gone reviews are kept until remove_unanswered_reviews(),
+# so they are checked again after restart if their notifications weren't enqueued
+def sync_unanswered_reviews(reviews, shop: shop_registry.Shop):
+    logger.debug('start: sync_unanswered_reviews()')
 
-        db.commit()
-        db.close()
-        logger.info('end: add_unanswered_review()')
+    with reviews_locker:
+        old_reviews = unanswered_index.setdefault(shop.code, {})
+        added = [review_id for review_id in reviews if review_id not in old_reviews]
+        gone = {review_id: review[1] for review_id, review in old_reviews.items() if review_id not in reviews}
+        # reviews saved before created_date column was added
+        undated = [review_id for review_id, review in old_reviews.items()
+                   if review[1] is None and review_id in reviews]
 
+        def write(db):
+            c = db.cursor()
 
-def remove_unanswered_review(review_id):
-    logger.info('start: remove_unanswered_review()')
+            c.executemany("""
+                    INSERT OR IGNORE INTO unanswered_reviews(shop, review_id, created_date) VALUES(?, ?, ?)
+                    """, [(shop.code, review_id, reviews[review_id]) for review_id in added])
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+            c.executemany("""
+                    UPDATE unanswered_reviews SET created_date = ? WHERE review_id = ?
+                    """, [(reviews[review_id], review_id) for review_id in undated])
 
-        c.execute(f"""
-                DELETE FROM unanswered_reviews WHERE review_id = '{review_id}'
-                """)
+        with sync_time.time(table='unanswered_reviews'):
+            writer.submit(write).result()
 
-        db.commit()
-        db.close()
-        logger.info('end: remove_unanswered_review()')
+        for review_id in added:
+            old_reviews[review_id] = [0, reviews[review_id]]
+        for review_id in undated:
+            old_reviews[review_id][1] = reviews[review_id]
 
+        logger.info(f'end: sync_unanswered_reviews(). Added: {len(added)}, gone: {len(gone)}')
+        return added, gone
 
-def add_past_review_id(review_id, shop: my_enums.Shop):
-    logger.info('start: add_past_review_id()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+def remove_unanswered_reviews(review_ids):
+    logger.debug('start: remove_unanswered_reviews()')
 
-        c.execute(f"""
-                INSERT INTO past_review_ids VALUES('{shop.value}', '{review_id}')
-                """)
+    with reviews_locker:
+        writer.executemany("""
+                DELETE FROM unanswered_reviews WHERE review_id = ?
+                """, [(review_id,) for review_id in review_ids]).result()
 
-        db.commit()
-        db.close()
-        logger.info('end: add_past_review_id()')
+        for reviews in unanswered_index.values():
+            for review_id in review_ids:
+                reviews.pop(review_id, None)
 
+        logger.debug('end: remove_unanswered_reviews()')
 
-def clear_past_review_ids(shop: my_enums.Shop):
-    logger.info('start: clear_past_review_ids()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+def is_review_seen(review_id, shop: shop_registry.Shop):
+    return seen_reviews.contains((shop.code, review_id), int(time.time()))
 
-        c.execute(f"""
-                DELETE FROM past_review_ids WHERE shop = '{shop.value}'
-                """)
 
-        db.commit()
-        db.close()
-        logger.info('end: clear_past_review_ids()')
+# remember ids of notified reviews. Returns ids which weren't seen before
+def add_seen_reviews(review_ids, shop: shop_registry.Shop, cur_time: int):
+    global seen_reviews_prune_date
+    logger.debug('start: add_seen_reviews()')
 
+    added = [review_id for review_id in review_ids if seen_reviews.add((shop.code, review_id), cur_time)]
 
-def get_past_review_ids(shop: my_enums.Shop):
-    logger.info('start: get_past_review_ids()')
+    with reviews_locker:
+        is_prune_time = seen_reviews_prune_date + seen_reviews_prune_delay <= cur_time
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+        def write(db):
+            c = db.cursor()
 
-        c.execute(f"""
-                SELECT review_id FROM past_review_ids WHERE shop = '{shop.value}'
-                """)
+            c.executemany("""
+                    INSERT OR IGNORE INTO seen_review_ids VALUES(?, ?, ?)
+                    """, [(shop.code, review_id, cur_time) for review_id in added])
 
-        ids = []
-        for review_id in c.fetchall():
-            ids.append(review_id[0])
+            if is_prune_time:
+                c.execute("""
+                        DELETE FROM seen_review_ids WHERE seen_date <= ?
+                        """, (cur_time - seen_review_ttl,))
 
-        db.close()
-        logger.info('end: get_past_review_ids()')
-        return ids
+        with sync_time.time(table='seen_review_ids'):
+            writer.submit(write).result()
+
+        if is_prune_time:
+            seen_reviews_prune_date = cur_time
+        seen_reviews.prune(cur_time)
+
+        logger.debug(f'end: add_seen_reviews(). Added: {len(added)}')
+        return added
+
+
+# returns Product or None if product of nmId wasn't received yet
+def get_product(nm_id):
+    cur_time = int(time.time())
+
+    product = products.get(nm_id, cur_time)
+    if product is not None:
+        return product
+
+    c = get_connection().cursor()
+
+    c.execute("""
+            SELECT name, supplier_article, update_date FROM products WHERE nm_id = ? AND update_date > ?
+            """, (nm_id, cur_time - product_ttl))
+
+    row = c.fetchone()
+    if row is None:
+        return None
+
+    product = Product(row[0], row[1])
+    products.put(nm_id, product, row[2])
+    return product
+
+
+# remember products of feedbacks. Only new and changed products are written, so known ones cost nothing
+def save_products(feedbacks, cur_time: int):
+    logger.debug('start: save_products()')
+
+    changed = {}
+    for feedback in feedbacks:
+        if feedback.product_name is None and feedback.supplier_article is None:
+            continue
+
+        product = Product(feedback.product_name, feedback.supplier_article)
+        if products.put(feedback.nm_id, product, cur_time):
+            changed[feedback.nm_id] = product
+
+    if len(changed) > 0:
+        with sync_time.time(table='products'):
+            writer.executemany("""
+                    INSERT OR REPLACE INTO products(nm_id, name, supplier_article, update_date) VALUES(?, ?, ?, ?)
+                    """, [(nm_id, product.name, product.supplier_article, cur_time)
+                          for nm_id, product in changed.items()]).result()
+
+    logger.debug(f'end: save_products(). Saved: {len(changed)}')
 
 
 def add_late_review_chat(chat_id, answer_notif: 0):
-    logger.info('[late_review_bot] start: add_late_review_chat()')
+    logger.debug('[late_review_bot] start: add_late_review_chat()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        writer.execute("""
+                INSERT INTO late_review_chats VALUES(?, ?)
+                """, (chat_id, answer_notif)).result(timeout=write_timeout)
 
-        c.execute(f"""
-                INSERT INTO late_review_chats VALUES({chat_id}, {answer_notif})
-                """)
-        db.commit()
-        db.close()
+        index_chat(late_review_chats_index, late_review_subscriptions, chat_id,
+                   {my_enums.NotifType.ANSWERS.value: answer_notif})
 
         logger.info(f'[late_review_bot] chat was added: {chat_id}')
-        logger.info('[late_review_bot] end: add_late_review_chat()')
+        logger.debug('[late_review_bot] end: add_late_review_chat()')
 
 
 def remove_late_review_chat(chat_id):
-    logger.info('[late_review_bot] start: remove_late_review_chat()')
+    logger.debug('[late_review_bot] start: remove_late_review_chat()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        writer.execute("""
+                DELETE FROM late_review_chats WHERE chat_id = ?
+                """, (chat_id,)).result(timeout=write_timeout)
 
-        c.execute(f"""
-                DELETE FROM late_review_chats WHERE chat_id = {chat_id}
-                """)
-        db.commit()
-        db.close()
+        unindex_chat(late_review_chats_index, late_review_subscriptions, chat_id)
 
         logger.info(f'[late_review_bot] chat was deleted: {chat_id}')
-        logger.info('[late_review_bot] end: remove_late_review_chat()')
+        logger.debug('[late_review_bot] end: remove_late_review_chat()')
 
 
 def get_late_review_chats(notif_type: my_enums.NotifType):
-    logger.info('[late_review_bot] start: get_late_review_chats()')
+    logger.debug('[late_review_bot] start: get_late_review_chats()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+    with chats_locker:
+        chat_list = list(late_review_subscriptions.get(notif_type.value, ()))
 
-        c.execute(f"""
-                SELECT chat_id FROM late_review_chats WHERE {notif_type.value} = 1 
-                """)
+    logger.debug('[late_review_bot] end: get_late_review_chats()')
+    return chat_list
 
-        chat_list = []
 
-        for row in c.fetchall():
-            chat_list.append(row[0])
+def is_late_review_chat_exists(chat_id):
+    logger.debug('[late_review_bot] start: is_late_review_chat_exists()')
 
-        db.close()
-        logger.info('[late_review_bot] end: get_late_review_chats()')
-        return chat_list
+    with chats_locker:
+        is_existed = chat_id in late_review_chats_index
 
+    if is_existed:
+        logger.debug('[late_review_bot] end: is_late_review_chat_exists() with True')
+        return True
+    else:
+        logger.debug('[late_review_bot] end: is_late_review_chat_exists() with False')
+        return False
 
-def is_late_review_chat_exists(chat_id):
-    logger.info('[late_review_bot] start: is_late_review_chat_exists()')
 
-    with locker:
-        db = sqlite3.connect(db_name)
-        c = db.cursor()
+# notifications: [(chat_id, review_id, kind, msg)]. Already enqueued notifications are ignored
+def enqueue_notifications(bot_name, notifications):
+    logger.debug(f'start: enqueue_notifications() for {bot_name}')
 
-        c.execute(f"SELECT chat_id FROM late_review_chats WHERE chat_id = {chat_id}")
-        existing_record = c.fetchone()
-        db.close()
+    cur_time = int(time.time())
 
-        if existing_record:
-            logger.info('[late_review_bot] end: is_late_review_chat_exists() with True')
-            return True
-        else:
-            logger.info('[late_review_bot] end: is_late_review_chat_exists() with False')
-            return False
+    # rowcount of executemany is the sum of inserted rows, ignored ones aren't counted
+    enqueued = writer.executemany("""
+            INSERT OR IGNORE INTO outbox(bot, chat_id, review_id, kind, msg, created_date)
+            VALUES(?, ?, ?, ?, ?, ?)
+            """, [(bot_name, chat_id, review_id, kind, msg, cur_time)
+                  for chat_id, review_id, kind, msg in notifications]).result()
+
+    logger.info(f'end: enqueue_notifications() for {bot_name}. Enqueued: {enqueued}')
+    return enqueued
+
+
+# returns [(id, chat_id, msg, attempts)] in order of enqueueing
+def get_pending_notifications(bot_name, max_attempts, limit=500):
+    logger.debug(f'start: get_pending_notifications() for {bot_name}')
+
+    c = get_connection().cursor()
+
+    c.execute("""
+            SELECT id, chat_id, msg, attempts FROM outbox
+            WHERE bot = ? AND delivered_date IS NULL AND attempts < ?
+            ORDER BY id LIMIT ?
+            """, (bot_name, max_attempts, limit))
+
+    notifications = c.fetchall()
+
+    logger.debug(f'end: get_pending_notifications() for {bot_name}')
+    return notifications
+
+
+def get_pending_notifications_count(bot_name, max_attempts):
+    c = get_connection().cursor()
+
+    c.execute("""
+            SELECT COUNT(*) FROM outbox WHERE bot = ? AND delivered_date IS NULL AND attempts < ?
+            """, (bot_name, max_attempts))
+
+    return c.fetchone()[0]
+
+
+def mark_notifications_delivered(notification_ids):
+    logger.debug('start: mark_notifications_delivered()')
+
+    cur_time = int(time.time())
+
+    writer.executemany("""
+            UPDATE outbox SET delivered_date = ? WHERE id = ?
+            """, [(cur_time, notification_id) for notification_id in notification_ids]).result()
+
+    logger.debug('end: mark_notifications_delivered()')
+
+
+def mark_notifications_failed(notification_ids):
+    logger.debug('start: mark_notifications_failed()')
+
+    writer.executemany("""
+            UPDATE outbox SET attempts = attempts + 1 WHERE id = ?
+            """, [(notification_id,) for notification_id in notification_ids]).result()
+
+    logger.debug('end: mark_notifications_failed()')
+
+
+# remove pending notifications of chat which blocked bot
+def remove_chat_notifications(bot_name, chat_id):
+    logger.debug('start: remove_chat_notifications()')
+
+    writer.execute("""
+            DELETE FROM outbox WHERE bot = ? AND chat_id = ? AND delivered_date IS NULL
+            """, (bot_name, chat_id)).result()
+
+    logger.debug('end: remove_chat_notifications()')
+
+
+def remove_old_notifications(max_age):
+    logger.debug('start: remove_old_notifications()')
+
+    writer.execute("""
+            DELETE FROM outbox WHERE created_date < ?
+            """, (int(time.time()) - max_age,)).result()
+
+    logger.debug('end: remove_old_notifications()')
@@ -5,8 +5,3 @@ class NotifType(Enum):
     ANSWERS = 'answer_notif'
     REVIEWS = 'review_notif'
     DEVELOP = 'develop_notif'
-
-
-class Shop(Enum):
-    KD = 'KD'
-    OB = 'OB'
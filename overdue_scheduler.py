@@ -0,0 +1,41 @@
+import heapq
+import threading
+
+
+# min-heap of review deadlines. Cancelled reviews stay in the heap and are skipped when they reach the top,
+# so every operation depends on number of due reviews, not on number of all unanswered reviews
+class OverdueScheduler:
+    def __init__(self):
+        self.locker = threading.Lock()
+        self.heap = []  # [(deadline, key)]
+        self.deadlines = {}  # {key: deadline}, only active entries
+
+    def schedule(self, key, deadline):
+        with self.locker:
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+
+    def cancel(self, key):
+        with self.locker:
+            self.deadlines.pop(key, None)
+
+    # returns keys which deadline is less or equal to cur_time and removes them from scheduler
+    def pop_due(self, cur_time):
+        due = []
+
+        with self.locker:
+            while len(self.heap) > 0 and self.heap[0][0] <= cur_time:
+                deadline, key = heapq.heappop(self.heap)
+
+                # skip cancelled and rescheduled entries
+                if self.deadlines.get(key) != deadline:
+                    continue
+
+                del self.deadlines[key]
+                due.append(key)
+
+        return due
+
+    def __len__(self):
+        with self.locker:
+            return len(self.deadlines)
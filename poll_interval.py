@@ -0,0 +1,25 @@
+import config
+
+# WB API limits requests per token, so shop is never polled more often than this
+min_allowed_interval = config.get('wb_api', {}).get('min_poll_interval', 10)  # seconds
+
+speedup_factor = 0.5  # interval multiplier when new reviews or answers are found
+slowdown_factor = 1.5  # interval multiplier when nothing happened
+
+
+# poll interval which gets shorter while reviews and answers are coming and longer while shop is idle
+class AdaptiveInterval:
+    def __init__(self, start_interval, min_interval, max_interval):
+        self.min_interval = max(min_interval, min_allowed_interval)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.interval = min(max(start_interval, self.min_interval), self.max_interval)
+
+    # activity: number of new reviews and answers, None if shop wasn't checked (WB error)
+    def next(self, activity):
+        if activity is not None and activity > 0:
+            self.interval = max(self.min_interval, self.interval * speedup_factor)
+        else:
+            # failed poll slows down like idle one. Long outages are stopped by circuit breaker of shop
+            self.interval = min(self.max_interval, self.interval * slowdown_factor)
+
+        return self.interval
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+
+
+# products by nmId which remembers every product for ttl seconds since the last update and not more than
+# max_size products. Products are kept in order of use, so the least recently used one is removed first
+class ProductCache:
+    def __init__(self, ttl, max_size):
+        self.locker = threading.Lock()
+        self.ttl = ttl  # seconds
+        self.max_size = max_size
+        self.products = OrderedDict()  # {nm_id: (product, update_date)}
+
+    # returns None if product is unknown or expired
+    def get(self, nm_id, cur_time):
+        with self.locker:
+            item = self.products.get(nm_id)
+            if item is None:
+                return None
+
+            product, update_date = item
+            if update_date + self.ttl <= cur_time:
+                del self.products[nm_id]
+                return None
+
+            self.products.move_to_end(nm_id)
+            return product
+
+    # returns True if product is new, changed or expired, so it should be saved
+    def put(self, nm_id, product, update_date):
+        with self.locker:
+            item = self.products.get(nm_id)
+            is_changed = item is None or item[0] != product or item[1] + self.ttl <= update_date
+
+            if is_changed:
+                self.products[nm_id] = (product, update_date)
+            self.products.move_to_end(nm_id)
+
+            if len(self.products) > self.max_size:
+                self.products.popitem(last=False)
+
+            return is_changed
+
+    def clear(self):
+        with self.locker:
+            self.products.clear()
+
+    def __len__(self):
+        with self.locker:
+            return len(self.products)
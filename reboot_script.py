@@ -1,30 +1,14 @@
 import os
 import time
-import datetime
 import subprocess
-from log_writer import logger
+from log_writer import get_logger
 
+logger = get_logger('reboot_script')
 
-# Данный модуль запускается через cron раз в сутки, чтобы удалить старые логи и перезагрузить систему.
-# Также происходит проверка, что рассылка в данный момент не активна, чтобы не прервать ее работу.
-
-
-def remove_old_logs():
-    logs_directory = 'logs'
-
-    days_threshold = 14
-    current_date = datetime.datetime.now()
 
-    for filename in os.listdir(logs_directory):
-        if filename.endswith('.log'):
-            file_path = os.path.join(logs_directory, filename)
-
-            modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
-            days_difference = (current_date - modified_date).days
-
-            if days_difference > days_threshold:
-                os.remove(file_path)
-                logger.info(f"[reboot]: Log file was deleted: {filename}")
+# Данный модуль запускается через cron раз в сутки, чтобы перезагрузить систему.
+# Старые логи удаляет log_writer при ротации.
+# Также происходит проверка, что рассылка в данный момент не активна, чтобы не прервать ее работу.
 
 
 def is_broadcast_active() -> bool:
@@ -53,5 +37,4 @@ def reboot_system():
 
 
 if __name__ == '__main__':
-    remove_old_logs()
     reboot_system()
@@ -0,0 +1,88 @@
+import time
+import random
+import config
+import requests
+import threading
+
+# settings from "wb_api" section of config.json
+api_settings = config.get('wb_api', {})
+max_retries = api_settings.get('max_retries', 3)
+base_retry_delay = api_settings.get('base_retry_delay', 1)  # seconds
+max_retry_delay = api_settings.get('max_retry_delay', 30)  # seconds
+breaker_failure_threshold = api_settings.get('breaker_failure_threshold', 5)  # failed requests in a row
+breaker_reset_timeout = api_settings.get('breaker_reset_timeout', 300)  # seconds
+
+retryable_status_codes = [429, 500, 502, 503, 504]
+
+
+# timeouts, connection errors, 5xx and 429 can pass later. Other errors (4xx) will repeat, so they are terminal
+def is_retryable(e: requests.exceptions.RequestException):
+    if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+
+    return e.response is not None and e.response.status_code in retryable_status_codes
+
+
+# exponential backoff with full jitter. Retry-After of 429 response is used as is
+def get_retry_delay(attempt, e: requests.exceptions.RequestException):
+    if e.response is not None and e.response.status_code == 429:
+        retry_after = e.response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+
+    return random.uniform(0, min(max_retry_delay, base_retry_delay * 2 ** attempt))
+
+
+# stops requests of the shop after many failures in a row, so WB outage doesn't take cycle time.
+# After reset_timeout one trial request is allowed, it closes breaker if it succeeds
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=breaker_failure_threshold, reset_timeout=breaker_reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.locker = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.is_trial_running = False
+
+    def allow_request(self):
+        with self.locker:
+            if self.opened_at is None:
+                return True
+
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.is_trial_running:
+                self.is_trial_running = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self.locker:
+            self.failures = 0
+            self.opened_at = None
+            self.is_trial_running = False
+
+    # returns True if breaker was opened by this failure
+    def record_failure(self):
+        with self.locker:
+            self.failures += 1
+            self.is_trial_running = False
+
+            if self.failures >= self.failure_threshold:
+                was_closed = self.opened_at is None
+                self.opened_at = time.monotonic()
+                return was_closed
+
+            return False
+
+
+breakers = {}  # {shop code: CircuitBreaker}
+locker = threading.Lock()
+
+
+def get_breaker(shop_code):
+    with locker:
+        if shop_code not in breakers:
+            breakers[shop_code] = CircuitBreaker(shop_code)
+
+        return breakers[shop_code]
@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+
+
+# set of ids which remembers every id for ttl seconds and not more than max_size ids.
+# Ids are kept in order of adding, so expired and extra ids are always at the beginning
+class SeenIds:
+    def __init__(self, ttl, max_size):
+        self.locker = threading.Lock()
+        self.ttl = ttl  # seconds
+        self.max_size = max_size
+        self.seen_dates = OrderedDict()  # {key: time when key was seen first}
+
+    # returns False if key was already seen, date of the first time is kept
+    def add(self, key, seen_date):
+        with self.locker:
+            if key in self.seen_dates:
+                return False
+
+            self.seen_dates[key] = seen_date
+
+            if len(self.seen_dates) > self.max_size:
+                self.seen_dates.popitem(last=False)
+
+            return True
+
+    def contains(self, key, cur_time):
+        with self.locker:
+            seen_date = self.seen_dates.get(key)
+            return seen_date is not None and seen_date + self.ttl > cur_time
+
+    # forget keys which were seen more than ttl seconds ago
+    def prune(self, cur_time):
+        with self.locker:
+            while len(self.seen_dates) > 0:
+                key, seen_date = next(iter(self.seen_dates.items()))
+                if seen_date + self.ttl > cur_time:
+                    break
+
+                del self.seen_dates[key]
+
+    def clear(self):
+        with self.locker:
+            self.seen_dates.clear()
+
+    def __len__(self):
+        with self.locker:
+            return len(self.seen_dates)
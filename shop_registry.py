@@ -0,0 +1,28 @@
+import config
+
+
+class Shop:
+    __slots__ = ('code', 'name', 'token', 'poll_interval', 'min_poll_interval', 'max_poll_interval')
+
+    def __init__(self, code, name, token, poll_interval=60, min_poll_interval=None, max_poll_interval=None):
+        self.code = code  # short key which is stored in db
+        self.name = name
+        self.token = token  # wildberries API token
+        # seconds. Interval starts from poll_interval and changes between min and max depending on activity
+        self.poll_interval = poll_interval
+        self.min_poll_interval = min_poll_interval if min_poll_interval is not None else poll_interval
+        self.max_poll_interval = max_poll_interval if max_poll_interval is not None else poll_interval
+
+    def __repr__(self):
+        return f'Shop({self.code})'
+
+
+# shops from "shops" section of config.json
+def load_shops():
+    shops = []
+
+    for shop in config.get('shops', []):
+        shops.append(Shop(shop['code'], shop.get('name', shop['code']), shop['token'],
+                          shop.get('poll_interval', 60), shop.get('min_poll_interval'), shop.get('max_poll_interval')))
+
+    return shops
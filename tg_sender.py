@@ -0,0 +1,237 @@
+import re
+import html
+import time
+import queue
+import telebot
+import metrics
+import threading
+import my_db as db
+from log_writer import get_logger
+
+logger = get_logger(__name__)
+
+
+# telegram limits: about 30 messages per second for bot and 1 message per second for chat
+global_rate = 30  # messages per second
+chat_rate = 1  # messages per second
+max_attempts = 3  # attempts to send one notification
+retry_delay = 30  # seconds between attempts
+dispatch_delay = 1  # seconds, how often outbox is checked without wake()
+max_msg_length = 4096  # telegram limit
+msg_separator = '\n\n〰〰〰〰〰\n\n'  # between notifications packed to one message
+
+send_time = metrics.Histogram('tg_send_seconds', 'Duration of one request to telegram')
+sent_msgs = metrics.Counter('tg_sent_messages_total', 'Messages sent to telegram')
+sent_notifications = metrics.Counter('tg_sent_notifications_total', 'Notifications delivered to chats')
+failed_msgs = metrics.Counter('tg_failed_messages_total', 'Messages which were not sent because of error')
+rate_limited_msgs = metrics.Counter('tg_rate_limited_total', 'Messages which got "too many requests" error')
+removed_chats = metrics.Counter('tg_blocked_chats_total', 'Chats removed because user blocked bot')
+outbox_pending = metrics.Gauge('outbox_pending', 'Notifications waiting for sending in outbox')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.locker = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.paused_until = 0
+
+    # waits until token is available and takes it
+    def acquire(self):
+        while True:
+            with self.locker:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+            time.sleep(delay)
+
+    # stop giving tokens for some time (retry_after from telegram)
+    def pause(self, seconds):
+        with self.locker:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# sends notifications from db outbox in background threads within telegram limits.
+# Notifications of one chat are always sent by the same worker, so their order is kept
+class Sender:
+    def __init__(self, bot: telebot.TeleBot, bot_name, on_blocked, log_prefix='', workers=4):
+        self.bot = bot
+        self.bot_name = bot_name  # key of bot's notifications in outbox
+        self.on_blocked = on_blocked  # called with chat id when user blocked bot (error 403)
+        self.log_prefix = log_prefix
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.blocked_chats = {}  # {chat: time when bot was blocked}
+        self.in_progress = set()  # ids of notifications which were given to workers
+        self.finished_dates = {}  # {notification id: time when worker finished it}
+        self.retry_dates = {}  # {notification id: time of next attempt}
+        self.new_notifications = threading.Event()
+        self.locker = threading.Lock()
+        self.is_started = False
+
+    # starts sending, notifications which weren't sent before restart are sent too
+    def start(self):
+        with self.locker:
+            if self.is_started:
+                return
+
+            threading.Thread(target=self.dispatcher, name=f'{self.bot_name}_dispatcher', daemon=True).start()
+            for i, msg_queue in enumerate(self.queues):
+                threading.Thread(target=self.worker, args=(msg_queue,), name=f'{self.bot_name}_sender_{i}',
+                                 daemon=True).start()
+
+            self.is_started = True
+
+    # tell sender that new notifications were put to outbox
+    def wake(self):
+        self.start()
+        self.new_notifications.set()
+
+    def get_chat_bucket(self, chat):
+        with self.locker:
+            if chat not in self.chat_buckets:
+                self.chat_buckets[chat] = TokenBucket(chat_rate, 1)
+
+            return self.chat_buckets[chat]
+
+    # gives pending notifications from outbox to workers
+    def dispatcher(self):
+        while True:
+            self.new_notifications.wait(dispatch_delay)
+            self.new_notifications.clear()
+
+            read_date = time.monotonic()
+            try:
+                notifications = db.get_pending_notifications(self.bot_name, max_attempts)
+                outbox_pending.set(db.get_pending_notifications_count(self.bot_name, max_attempts), bot=self.bot_name)
+            except Exception as e:
+                logger.error(f'{self.log_prefix}Error while reading outbox: {e}')
+                continue
+
+            # notifications of the same chat are packed to one message
+            now = time.monotonic()
+            chat_notifications = {}
+            for notification_id, chat, msg, attempts in notifications:
+                with self.locker:
+                    # notification could be finished while outbox was read, then it's still pending in the result
+                    if notification_id in self.in_progress or self.finished_dates.get(notification_id, 0) >= read_date \
+                            or self.retry_dates.get(notification_id, 0) > now:
+                        continue
+
+                    self.in_progress.add(notification_id)
+
+                chat_notifications.setdefault(chat, []).append((notification_id, msg))
+
+            for chat, chat_msgs in chat_notifications.items():
+                for notification_ids, msg in pack_msgs(chat_msgs):
+                    self.queues[hash(chat) % len(self.queues)].put((notification_ids, chat, msg, now))
+
+            with self.locker:
+                self.finished_dates = {notification_id: finished_date for notification_id, finished_date
+                                       in self.finished_dates.items() if finished_date >= read_date}
+                self.retry_dates = {notification_id: retry_date for notification_id, retry_date
+                                    in self.retry_dates.items() if retry_date > now}
+
+    def worker(self, msg_queue: queue.Queue):
+        while True:
+            notification_ids, chat, msg, queued_at = msg_queue.get()
+
+            try:
+                # skip notifications which were queued before user blocked bot
+                if self.blocked_chats.get(chat, -1) < queued_at:
+                    self.send(notification_ids, chat, msg)
+            except Exception as e:
+                logger.error(f'{self.log_prefix}Error while sending notifications {notification_ids}: {e}')
+            finally:
+                with self.locker:
+                    for notification_id in notification_ids:
+                        self.in_progress.discard(notification_id)
+                        self.finished_dates[notification_id] = time.monotonic()
+
+    def send(self, notification_ids, chat, msg):
+        while True:
+            self.get_chat_bucket(chat).acquire()
+            self.global_bucket.acquire()
+
+            try:
+                with send_time.time(bot=self.bot_name):
+                    self.bot.send_message(chat, msg, parse_mode='html')
+                db.mark_notifications_delivered(notification_ids)
+                sent_msgs.inc(bot=self.bot_name)
+                sent_notifications.inc(len(notification_ids), bot=self.bot_name)
+                logger.info(f'{self.log_prefix}msg sent to chat: {chat}. Notifications: {len(notification_ids)}')
+                return
+            except Exception as e:
+                if isinstance(e, telebot.apihelper.ApiTelegramException) and e.result_json['error_code'] == 403:
+                    logger.info(f"{self.log_prefix}chat {chat}: user blocked bot "
+                                f"(Error: {e.result_json['error_code']})")
+                    self.blocked_chats[chat] = time.monotonic()
+                    removed_chats.inc(bot=self.bot_name)
+                    self.on_blocked(chat)
+                    db.remove_chat_notifications(self.bot_name, chat)
+                    return
+                elif isinstance(e, telebot.apihelper.ApiTelegramException) and e.result_json['error_code'] == 429:
+                    # doesn't count as failed attempt, telegram just asks to wait
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    logger.warning(f'{self.log_prefix}Too many requests. Retry after {retry_after} seconds')
+                    rate_limited_msgs.inc(bot=self.bot_name)
+                    self.global_bucket.pause(retry_after)
+                else:
+                    logger.warning(f"{self.log_prefix}Couldn't send msg to chat: {chat}. Error: {e}")
+                    db.mark_notifications_failed(notification_ids)
+                    failed_msgs.inc(bot=self.bot_name)
+                    with self.locker:
+                        for notification_id in notification_ids:
+                            self.retry_dates[notification_id] = time.monotonic() + retry_delay
+                    return
+
+
+# packs notifications [(id, msg)] to messages [([ids], msg)] not longer than telegram limit.
+# Messages are split only between notifications, so html tags of every notification stay closed
+def pack_msgs(notifications):
+    packed = []
+    notification_ids = []
+    msg = ''
+
+    for notification_id, notification_msg in notifications:
+        if len(notification_msg) > max_msg_length:
+            notification_msg = shorten_msg(notification_msg)
+
+        if len(notification_ids) > 0 and len(msg) + len(msg_separator) + len(notification_msg) > max_msg_length:
+            packed.append((notification_ids, msg))
+            notification_ids = []
+            msg = ''
+
+        msg = msg + msg_separator + notification_msg if len(notification_ids) > 0 else notification_msg
+        notification_ids.append(notification_id)
+
+    if len(notification_ids) > 0:
+        packed.append((notification_ids, msg))
+
+    return packed
+
+
+# too long notification is sent as plain text, because html can't be cut safely
+def shorten_msg(msg):
+    text = html.unescape(re.sub(r'<[^>]+>', '', msg))
+    shortened = ''
+
+    # escaped text is longer than original one, so length is checked after escaping
+    for char in text:
+        escaped_char = html.escape(char)
+        if len(shortened) + len(escaped_char) > max_msg_length - 3:
+            break
+
+        shortened += escaped_char
+
+    return shortened + '...'
@@ -1,299 +1,522 @@
 import re
+import html
 import time
 import requests
+import wb_client
+import retry_policy
 import my_enums
+import shop_registry
+import metrics
 import datetime
 import my_db as db
-from log_writer import logger
-
-
-def get_new_reviews(wb_api_token, shop: my_enums.Shop):
-    logger.info(f'start: get_new_reviews() for {shop.value}')
-
-    new_feedbacks = []
-    last_check_date = db.get_last_check_date(shop, my_enums.NotifType.REVIEWS)
-
-    url = 'https://feedbacks-api.wb.ru/api/v1/feedbacks'
-    headers = {
-        'Authorization': f'{wb_api_token}'
-    }
+from log_writer import get_logger
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from models import Feedback
+from overdue_scheduler import OverdueScheduler
+
+logger = get_logger(__name__)
+
+# unanswered feedbacks of a shop fetched once per broadcast cycle
+FeedbacksSnapshot = namedtuple('FeedbacksSnapshot', ['feedbacks', 'fetch_time'])
+
+overdue_limit = 600  # seconds
+# WB answers with these codes if requested review doesn't exist (422 for stale ID)
+not_found_status_codes = [404, 422]
+msk_timezone = datetime.timezone(datetime.timedelta(hours=3))
+# deadlines of unanswered reviews, key is (shop, review_id)
+overdue_scheduler = OverdueScheduler()
+# feedbacks of the latest snapshot for overdue notifications: {shop: {review_id: feedback}}
+latest_feedbacks = {}
+latest_fetch_times = {}  # {shop: fetch_time of the latest snapshot}
+overdue_retry_delay = 10  # seconds, delay before next check of due review which couldn't be checked now
+
+wb_request_time = metrics.Histogram('wb_request_seconds', 'Duration of one request to WB API')
+wb_retries = metrics.Counter('wb_retries_total', 'Requests to WB API which were retried')
+wb_failed_requests = metrics.Counter('wb_failed_requests_total', 'Requests to WB API which failed after all attempts')
+wb_skipped_requests = metrics.Counter('wb_skipped_requests_total', 'Requests to WB API skipped by open circuit breaker')
+
+
+def get_feedbacks_snapshot(shop: shop_registry.Shop):
+    logger.debug(f'start: get_feedbacks_snapshot() for {shop.code}')
+
+    # one fetch per shop per cycle, all detectors work with this snapshot
     params = {
         'isAnswered': 'false',
-        'take': '5000',
-        'skip': '0',
-        'dateFrom': f'{last_check_date}'
     }
 
     cur_time = int(datetime.datetime.now().timestamp())
-    response = get_response_with_retry(url, headers, params, shop)
-    if response is None:
-        logger.warning(f'end: get_new_reviews() with None for {shop.value}')
+    feedbacks = []
+    try:
+        for feedback in iter_feedbacks(shop, params):
+            feedbacks.append(feedback)
+    except FeedbacksRequestError as e:
+        # snapshot must be full, otherwise missed reviews will be taken as answered
+        logger.warning(f'end: get_feedbacks_snapshot() with None for {shop.code}: {e}')
+        return None
+
+    if len(feedbacks) > 100:
+        logger.warning(f"{shop.name}: too much unprocessed reviews: {len(feedbacks)}. Program may work slowly")
+
+    latest_feedbacks[shop] = {feedback.id: feedback for feedback in feedbacks}
+    latest_fetch_times[shop] = cur_time
+    # products are taken from the same pages, so no requests are made for them
+    db.save_products(feedbacks, cur_time)
+
+    logger.debug(f'end: get_feedbacks_snapshot() for {shop.code}')
+    return FeedbacksSnapshot(feedbacks, cur_time)
+
+
+# yields feedbacks page by page following 'skip' until the list is exhausted. If the page is full, next pages
+# are requested in parallel while the current one is processed. Raises FeedbacksRequestError if page wasn't received
+def iter_feedbacks(shop: shop_registry.Shop, params, page_size=5000, parallel_pages=2, max_pages=None):
+    path = '/api/v1/feedbacks'
+
+    executor = ThreadPoolExecutor(max_workers=parallel_pages, thread_name_prefix=f'{shop.code}_pages')
+    requested_pages = deque()
+    next_page = 0
+
+    def request_page():
+        nonlocal next_page
+        page_params = dict(params, take=f'{page_size}', skip=f'{next_page * page_size}')
+        requested_pages.append(executor.submit(get_response_with_retry, path, page_params, shop))
+        next_page += 1
+
+    # the first page is requested alone, most of the time there are no more pages
+    request_page()
+
+    try:
+        while len(requested_pages) > 0:
+            response = requested_pages.popleft().result()
+            if response is None:
+                raise FeedbacksRequestError('page of feedbacks was not received')
+
+            # json is parsed once, raw dicts are freed after conversion
+            feedbacks = [Feedback.from_json(feedback) for feedback in response.json()['data']['feedbacks']]
+            del response
+
+            # request next pages if this one is full, otherwise it's the last page
+            if len(feedbacks) == page_size:
+                while len(requested_pages) < parallel_pages and (max_pages is None or next_page < max_pages):
+                    request_page()
+
+            yield from feedbacks
+
+            # pages requested after the last one are not needed, so their errors don't break the received list
+            if len(feedbacks) < page_size:
+                break
+    finally:
+        # pages which are not needed anymore (the last page was received, error or the caller stopped iteration).
+        # Running requests aren't waited for, their results are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FeedbacksRequestError(Exception):
+    pass
+
+
+class ReviewNotFoundError(Exception):
+    pass
+
+
+# returns [(review_id, msg)]. Nothing is saved here, save_new_reviews() is called after notifications are enqueued
+def get_new_reviews(snapshot: FeedbacksSnapshot, shop: shop_registry.Shop):
+    logger.debug(f'start: get_new_reviews() for {shop.code}')
+
+    new_feedbacks = []
+    if snapshot is None:
+        logger.warning(f'end: get_new_reviews() with None for {shop.code}')
         return new_feedbacks
 
-    if response.status_code == 200 and len(response.json()['data']['feedbacks']) > 0:
-        db.update_last_check_date(shop, my_enums.NotifType.REVIEWS, cur_time)
+    # same as 'dateFrom' param of WB API, but applied to the shared snapshot
+    last_check_date = db.get_last_check_date(shop, my_enums.NotifType.REVIEWS)
+    feedbacks = [feedback for feedback in snapshot.feedbacks if feedback.created_date >= last_check_date]
 
-        # add new unanswered feedbacks to the list
-        feedbacks = response.json()['data']['feedbacks']
-        past_feedbacks_ids = db.get_past_review_ids(shop)
+    if len(feedbacks) > 0:
+        batch_ids = set()
 
         # form messages from new unanswered reviews
         for feedback in feedbacks:
             # sometimes feedback can be duplicated, this 'if' will prevent it
-            if feedback['id'] in past_feedbacks_ids:
-                logger.warning(f"duplicated feedback was deleted. ID: {feedback['id']}")
+            if feedback.id in batch_ids or db.is_review_seen(feedback.id, shop):
+                logger.warning(f'duplicated feedback was deleted. ID: {feedback.id}')
                 continue
 
-            feedback_text = feedback['text'] if feedback['text'] != '' else 'отсутствует'
-            new_feedbacks.append('<b><u>Добавлен новый отзыв!</u></b>' + \
-                                 '\n\n<b>Магазин:</b> ' + feedback['productDetails']['brandName'] + \
-                                 '\n\n<b>Оценка:</b> ' + str(feedback['productValuation']) + \
+            batch_ids.add(feedback.id)
+
+            feedback_text = html.escape(feedback.text) if feedback.text != '' else 'отсутствует'
+            new_feedbacks.append((feedback.id, '<b><u>Добавлен новый отзыв!</u></b>' + \
+                                 '\n\n<b>Магазин:</b> ' + html.escape(feedback.brand) + \
+                                 '\n\n<b>Оценка:</b> ' + str(feedback.valuation) + \
                                  '\n<b>Комментарий:</b><i> ' + feedback_text + '</i>' + \
-                                 '\n\n<b>Отзыв оставлен: </b>' + remove_sz_from_date(feedback['createdDate']) + \
-                                 '\n<b>ID:</b> ' + feedback['id'])
+                                 '\n\n<b>Отзыв оставлен: </b>' + format_date(feedback.created_date) + \
+                                 '\n\n' + format_product(feedback) + \
+                                 '\n<b>ID:</b> ' + feedback.id))
 
-        # update past reviews list
-        db.clear_past_review_ids(shop)
-        for feedback in feedbacks:
-            db.add_past_review_id(feedback['id'], shop)
+    logger.debug(f'end: get_new_reviews() for {shop.code}')
+    return new_feedbacks
 
-    elif response.status_code == 200:
-        db.update_last_check_date(shop, my_enums.NotifType.REVIEWS, cur_time)
-    else:
-        logger.warning(f'get_new_reviews(): Shop: {shop}. Response code: {response.status_code} ' + str(response.text))
-        logger.warning('get_new_reviews(): response code not 2xx so try later')
 
-    logger.info(f'end: get_new_reviews() for {shop.value}')
-    return new_feedbacks
+# new_reviews: result of get_new_reviews(). If bot stops before this call, reviews are found again after restart,
+# outbox doesn't enqueue the same notification twice
+def save_new_reviews(new_reviews, snapshot: FeedbacksSnapshot, shop: shop_registry.Shop):
+    # remember notified reviews, so they are skipped if WB returns them again
+    db.add_seen_reviews([review_id for review_id, _ in new_reviews], shop, snapshot.fetch_time)
+    db.update_last_check_date(shop, my_enums.NotifType.REVIEWS, snapshot.fetch_time)
 
 
-def get_new_answers(wb_api_token, shop: my_enums.Shop):
-    logger.info(f'start: get_new_answers() for {shop.value}')
+# returns ([(review_id, msg)], ids of resolved reviews). Resolved reviews are removed by save_new_answers()
+# after notifications are enqueued
+def get_new_answers(snapshot: FeedbacksSnapshot, shop: shop_registry.Shop):
+    logger.debug(f'start: get_new_answers() for {shop.code}')
 
     new_answers = []
-    # don't show answer creation date if error is more than this
-    max_error_delay = 120  # seconds
+    resolved_ids = []
+    # answer is found by the next poll, so its time is late by up to the poll interval. It's not shown if the previous
+    # check was longer ago than the longest poll interval of shop (bot or WB was down), delay of poll is allowed
+    max_error_delay = shop.max_poll_interval + 120  # seconds
+
+    if snapshot is None:
+        logger.warning(f'end: get_new_answers() with None for {shop.code}')
+        return new_answers, resolved_ids
+
+    feedbacks = snapshot.feedbacks
+    # previous check of this shop, answers were received after it
+    last_check_date = db.get_last_check_date(shop, my_enums.NotifType.ANSWERS)
+
+    # add new unanswered reviews to db and get reviews which are not unanswered anymore (answered or deleted).
+    # Gone reviews stay in db until their notifications are enqueued
+    current_reviews = {}
+    for feedback in feedbacks:
+        current_reviews[feedback.id] = feedback.created_date
 
-    url = 'https://feedbacks-api.wb.ru/api/v1/feedbacks'
-    headers = {
-        'Authorization': f'{wb_api_token}'
-    }
-    params = {
-        'isAnswered': 'false',
-        'take': '5000',
-        'skip': '0',
-    }
+    added_feedback_ids, gone_feedbacks = db.sync_unanswered_reviews(current_reviews, shop)
 
-    response = get_response_with_retry(url, headers, params, shop)
-    if response is None:
-        logger.warning(f'end: get_new_answers() with None for {shop.value}')
-        return new_answers
-    elif len(response.json()['data']['feedbacks']) > 100:
-        logger.warning(f"Too much unprocessed reviews: {len(response.json()['data']['feedbacks'])}. Program may work "
-                       f"slowly")
+    # start waiting for answer for new reviews and stop it for answered ones
+    for feedback_id in added_feedback_ids:
+        overdue_scheduler.schedule((shop, feedback_id), current_reviews[feedback_id] + overdue_limit)
+    for feedback_id in gone_feedbacks:
+        overdue_scheduler.cancel((shop, feedback_id))
 
-    if response.status_code == 200:
-        feedbacks = response.json()['data']['feedbacks']
-        old_feedback_ids = db.get_unanswered_ids(shop)
-        current_feedback_ids = []
+    if len(gone_feedbacks) > 0:
+        # creation dates of reviews saved by old versions are unknown, so search through the latest answered reviews
+        if None not in gone_feedbacks.values():
+            date_from = min(gone_feedbacks.values())
+        else:
+            date_from = None
 
-        # get current unanswered review ids
-        for feedback in feedbacks:
-            current_feedback_ids.append(feedback['id'])
-
-        # find old review in current_review_list. If it's not in, delete that from db and send
-        for old_feedback_id in old_feedback_ids:
-            if old_feedback_id not in current_feedback_ids:
-                feedback = get_review_by_id(old_feedback_id, wb_api_token, shop)
-
-                if feedback is None:
-                    logger.warning('feedback is None')
-                    continue
-                elif feedback['answer'] is None:
-                    db.remove_unanswered_review(old_feedback_id)
-                    logger.info('review was deleted from DB because it was deleted in wb')
-                    continue
-
-                cur_time = int(datetime.datetime.now().timestamp())
-
-                # не указывать дату написания ответа, если погрешность более X секунд
-                if db.get_broadcast_last_check_date() + max_error_delay > cur_time:
-                    answer_received = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
-                else:
-                    answer_received = '<i>не удалось установить</i>'
-
-                feedback_text = '\n<i>' + feedback['text'] + '</i>' if feedback['text'] != '' else '<i>отсутствует</i>'
-                feedback_answer = '\n<i>' + feedback['answer']['text'] + '</i>' if feedback['answer']['text'] != '' else '<i>отсутствует</i>'
-
-                new_answers.append(f'<b><u>Добавлен новый ответ!</u></b>' + \
-                                   '\n\n<b>Магазин:</b> ' + feedback['productDetails']['brandName'] + \
-                                   '\n\n<b>Оценка:</b> ' + str(feedback['productValuation']) + \
-                                   '\n<b>Комментарий:</b> ' + feedback_text + \
-                                   '\n\n<b>Ответ продавца:</b> ' + feedback_answer + \
-                                   '\n\n<b>Отзыв оставлен:</b> ' + remove_sz_from_date(feedback['createdDate']) + \
-                                   f'\n<b>Ответ получен:</b> {answer_received}' + \
-                                   f"\n\n<b>Артикул:</b> {feedback['productDetails']['nmId']}" + \
-                                   '\n<b>ID:</b> ' + feedback['id'])
-
-                db.remove_unanswered_review(old_feedback_id)
-
-        # add current unanswered review if it's not in db
-        for current_feedback_id in current_feedback_ids:
-            if current_feedback_id not in old_feedback_ids:
-                db.add_unanswered_review(current_feedback_id, shop)
+        answered_feedbacks = get_answered_feedbacks(gone_feedbacks, shop, date_from)
     else:
-        logger.warning(f'Shop: {shop}. Response code: ' + str(response.status_code) + str(response.text))
+        answered_feedbacks = {}
+
+    # form messages for answered reviews
+    for old_feedback_id, created_date in gone_feedbacks.items():
+        feedback = answered_feedbacks.get(old_feedback_id)
+
+        # fallback for reviews which weren't found in answered list
+        if feedback is None:
+            try:
+                feedback = get_review_by_id(old_feedback_id, shop)
+            except ReviewNotFoundError:
+                # review was deleted in WB, so it won't be answered
+                logger.warning(f'review {old_feedback_id} is not found in WB, it will be deleted from DB')
+                resolved_ids.append(old_feedback_id)
+                continue
 
-    logger.info(f'end: get_new_answers() for {shop.value}')
-    return new_answers
+        # review couldn't be resolved now, it stays in db and will be checked again in the next cycle
+        if feedback is None:
+            logger.warning('feedback is None')
+            continue
 
+        resolved_ids.append(old_feedback_id)
 
-def get_overdue_reviews(wb_api_token, shop: my_enums.Shop):
-    logger.info(f'start: get_overdue_reviews() for {shop.value}')
+        if feedback.answer is None:
+            logger.info('review will be deleted from DB because it was deleted in wb')
+            continue
 
-    overdue_answers = []
-    overdue_limit = 600  # seconds
+        cur_time = int(datetime.datetime.now().timestamp())
 
-    url = 'https://feedbacks-api.wb.ru/api/v1/feedbacks'
-    headers = {
-        'Authorization': f'{wb_api_token}'
-    }
-    params = {
-        'isAnswered': 'false',
-        'take': '5000',
-        'skip': '0',
-    }
+        # не указывать дату написания ответа, если погрешность более X секунд
+        if last_check_date + max_error_delay > cur_time:
+            answer_received = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+        else:
+            answer_received = '<i>не удалось установить</i>'
 
-    response = get_response_with_retry(url, headers, params, shop)
-    if response is None:
-        logger.warning(f'end: get_overdue_reviews() with None for {shop.value}')
-        return overdue_answers
+        feedback_text = '\n<i>' + html.escape(feedback.text) + '</i>' if feedback.text != '' else '<i>отсутствует</i>'
+        feedback_answer = '\n<i>' + html.escape(feedback.answer) + '</i>' if feedback.answer != '' else '<i>отсутствует</i>'
 
-    feedbacks = response.json()['data']['feedbacks']
-    current_unanswered_reviews = db.get_unanswered_ids(shop)
-    cur_time = int(datetime.datetime.now().timestamp())
+        new_answers.append((feedback.id, f'<b><u>Добавлен новый ответ!</u></b>' + \
+                           '\n\n<b>Магазин:</b> ' + html.escape(feedback.brand) + \
+                           '\n\n<b>Оценка:</b> ' + str(feedback.valuation) + \
+                           '\n<b>Комментарий:</b> ' + feedback_text + \
+                           '\n\n<b>Ответ продавца:</b> ' + feedback_answer + \
+                           '\n\n<b>Отзыв оставлен:</b> ' + format_date(feedback.created_date) + \
+                           f'\n<b>Ответ получен:</b> {answer_received}' + \
+                           '\n\n' + format_product(feedback) + \
+                           '\n<b>ID:</b> ' + feedback.id))
 
-    for feedback in feedbacks:
-        is_overdue = convert_sz_date_to_timestamp(feedback['createdDate']) < cur_time - overdue_limit
-        # is_work_time = is_time_between_9_and_21(feedback['createdDate'])
+    logger.debug(f'end: get_new_answers() for {shop.code}')
+    return new_answers, resolved_ids
+
+
+# resolved_ids: result of get_new_answers(). If bot stops before this call, reviews are resolved again after restart,
+# outbox doesn't enqueue the same notification twice
+def save_new_answers(resolved_ids, snapshot: FeedbacksSnapshot, shop: shop_registry.Shop):
+    if len(resolved_ids) > 0:
+        db.remove_unanswered_reviews(resolved_ids)
 
-        # заказчик решил отправлять уведомления о задержке в нерабочее время.
-        # с большей вероятностью он передумает. тогда условие нужно заменить на нижестоящее
-        # if is_overdue and is_work_time and feedback['id'] in current_unanswered_reviews:
+    db.update_last_check_date(shop, my_enums.NotifType.ANSWERS, snapshot.fetch_time)
 
-        if is_overdue and feedback['id'] in current_unanswered_reviews:
-            review_ntf_status = db.get_unanswered_review_ntf_status(feedback['id'])
-            # check if ntf about this review wasn't sent yet
+
+# schedule notifications about overdue reviews which were saved to db before start
+def init_overdue_reviews(shops):
+    logger.debug('start: init_overdue_reviews()')
+
+    for shop in shops:
+        for review_id, (review_ntf_status, created_date) in db.get_unanswered_reviews(shop).items():
             if review_ntf_status == 0:
-                feedback_text = '\n<i>' + feedback['text'] + '</i>' if feedback['text'] != '' else '<i>отсутствует</i>'
-                overdue_answers.append(f'<b><u>На отзыв нет ответа более 10 минут</u></b>' + \
-                                       '\n\n<b>Магазин:</b> ' + feedback['productDetails']['brandName'] + \
-                                       '\n\n<b>Оценка:</b> ' + str(feedback['productValuation']) + \
-                                       '\n<b>Комментарий:</b> ' + feedback_text + \
-                                       '\n\n<b>Отзыв оставлен:</b> ' + remove_sz_from_date(feedback['createdDate']) + \
-                                       f"\n\n<b>Артикул:</b> {feedback['productDetails']['nmId']}" + \
-                                       '\n<b>ID:</b> ' + feedback['id'])
-                db.make_unanswered_review_dirty(feedback['id'])
-
-    logger.info(f'end: get_overdue_reviews() for {shop.value}')
-    return overdue_answers
-
-
-def get_review_by_id(review_id, wb_api_token, shop: my_enums.Shop):
-    logger.info(f'start: get_review_by_id() for {shop.value}')
-
-    url = 'https://feedbacks-api.wb.ru/api/v1/feedback'
-    headers = {
-        'Authorization': f'{wb_api_token}'
-    }
-    params = {
-        'id': f'{review_id}'
-    }
+                # creation date is unknown for old reviews, it will be checked after the first snapshot
+                deadline = created_date + overdue_limit if created_date is not None else 0
+                overdue_scheduler.schedule((shop, review_id), deadline)
 
-    response = get_response_with_retry(url, headers, params, shop)
-    if response is None:
-        logger.warning(f'end: get_review_by_id() with None for {shop.value}')
-        return None
-    else:
-        logger.info(f'end: get_review_by_id() for {shop.value}')
-        return response.json()['data']
+    logger.info(f'end: init_overdue_reviews(). Scheduled: {len(overdue_scheduler)}')
 
 
-def get_response_with_retry(url, headers, params, shop: my_enums.Shop, max_retries=3, retry_delay=10):
-    logger.info(f'start: get_response_with_retry() for {shop.value}')
+# returns [(shop, review_id, msg)] of reviews which deadline has come
+def get_overdue_reviews():
+    overdue_reviews = []
 
-    while True:
+    cur_time = int(datetime.datetime.now().timestamp())
+    due_reviews = overdue_scheduler.pop_due(cur_time)
+    if len(due_reviews) == 0:
+        return overdue_reviews
+
+    logger.debug(f'start: get_overdue_reviews(). Due reviews: {len(due_reviews)}')
+
+    for shop, review_id in due_reviews:
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=20)
-            response.raise_for_status()  # Raises an exception for non-2xx responses
-            logger.info(f'end: get_response_with_retry() for {shop.value}')
-            return response
+            msg = check_overdue_review(shop, review_id, cur_time)
         except Exception as e:
-            if isinstance(e, requests.exceptions.RequestException):
-                if max_retries > 0:
-                    max_retries -= 1
-                    logger.warning(f'Shop {shop.value}. An error occurred: {e}. Retrying in {retry_delay} seconds...')
-                    time.sleep(retry_delay)
-                else:
-                    logger.warning('Max retries reached. Could not establish connection.')
-
-                    if e.response is None:
-                        print('e.response is None')
-                        return None
-
-                    if e.response.status_code == 422:
-                        pattern = r'id=(\d+)'
-                        match = re.search(pattern, str(e))
-                        if match:
-                            review_id = match.group(1)
-                            db.remove_unanswered_review(review_id)
-                            logger.warning(f'ID ({review_id}) was deleted from db because it does not exist anymore')
-
-                    logger.info(f'end: get_response_with_retry() for {shop.value}')
-                    return None
-            else:
-                logger.error(f'Unknown exception in get_response_with_retry(): {e}')
-                logger.info(f'end: get_response_with_retry() for {shop.value}')
-                return None
+            # review was removed from scheduler, so it's checked again later
+            logger.error(f'Error while checking overdue review {review_id}: {e}')
+            reschedule_overdue_reviews([(shop, review_id)])
+            continue
+
+        if msg is not None:
+            overdue_reviews.append((shop, review_id, msg))
+
+    logger.debug('end: get_overdue_reviews()')
+    return overdue_reviews
+
+
+# returns message about overdue review or None if review isn't overdue, it's rescheduled if its deadline is later
+def check_overdue_review(shop: shop_registry.Shop, review_id, cur_time):
+    # check if ntf about this review wasn't sent yet and review is still unanswered
+    if db.get_unanswered_review_ntf_status(review_id) != 0:
+        return None
+
+    if shop not in latest_feedbacks:
+        reschedule_overdue_reviews([(shop, review_id)])
+        return None
 
+    # review was answered after the latest snapshot, get_new_answers() will process it
+    feedback = latest_feedbacks[shop].get(review_id)
+    if feedback is None:
+        return None
+
+    deadline = feedback.created_date + overdue_limit
+    if deadline > cur_time:
+        overdue_scheduler.schedule((shop, review_id), deadline)
+        return None
 
-def remove_sz_from_date(date):
-    logger.info(f'start: convert_date()')
+    # snapshot was fetched before deadline, so review could be answered in time after it. It's checked by request
+    if latest_fetch_times.get(shop, 0) < deadline:
+        try:
+            feedback = get_review_by_id(review_id, shop)
+        except ReviewNotFoundError:
+            return None
+
+        if feedback is None:
+            reschedule_overdue_reviews([(shop, review_id)])
+            return None
+        elif feedback.answer is not None:
+            # get_new_answers() will notify about answer
+            return None
+
+    # is_work_time = is_time_between_9_and_21(feedback.created_date)
+    # заказчик решил отправлять уведомления о задержке в нерабочее время.
+    # с большей вероятностью он передумает. тогда нужно пропускать отзывы, где not is_work_time
+
+    feedback_text = '\n<i>' + html.escape(feedback.text) + '</i>' if feedback.text != '' else '<i>отсутствует</i>'
+    return f'<b><u>На отзыв нет ответа более 10 минут</u></b>' + \
+           '\n\n<b>Магазин:</b> ' + html.escape(feedback.brand) + \
+           '\n\n<b>Оценка:</b> ' + str(feedback.valuation) + \
+           '\n<b>Комментарий:</b> ' + feedback_text + \
+           '\n\n<b>Отзыв оставлен:</b> ' + format_date(feedback.created_date) + \
+           '\n\n' + format_product(feedback) + \
+           '\n<b>ID:</b> ' + feedback.id
+
+
+# keys: [(shop, review_id)] of due reviews which couldn't be checked or notified now, they are checked again later
+def reschedule_overdue_reviews(keys):
+    cur_time = int(datetime.datetime.now().timestamp())
 
-    # Преобразование полученной даты в объект datetime
-    input_datetime = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+    for key in keys:
+        overdue_scheduler.schedule(key, cur_time + overdue_retry_delay)
 
-    # Перевод времени на МСК
-    adjusted_datetime = input_datetime + datetime.timedelta(hours=3)
 
-    # Форматирование даты и времени в требуемом формате
-    logger.info(f'end: convert_date()')
-    return adjusted_datetime.strftime('%Y-%m-%d %H:%M')
+def get_answered_feedbacks(review_ids, shop: shop_registry.Shop, date_from=None, page_size=1000, max_pages=5):
+    logger.debug(f'start: get_answered_feedbacks() for {shop.code}')
 
+    # search reviews by pages of answered feedbacks instead of request for every ID
+    wanted_ids = set(review_ids)
+    answered_feedbacks = {}
 
-def convert_sz_date_to_timestamp(sz_date_string):
-    logger.info(f'start: convert_sz_date_to_timestamp()')
+    params = {
+        'isAnswered': 'true',
+        'order': 'dateDesc'
+    }
+    if date_from is not None:
+        params['dateFrom'] = f'{date_from}'
 
-    # Преобразование строки в объект datetime
-    date_object = datetime.datetime.strptime(sz_date_string, "%Y-%m-%dT%H:%M:%SZ") + datetime.timedelta(hours=3)
-    timestamp = date_object.timestamp()
+    # pages are requested one by one, because search usually stops on the first page
+    try:
+        for feedback in iter_feedbacks(shop, params, page_size, parallel_pages=1, max_pages=max_pages):
+            if feedback.id in wanted_ids:
+                answered_feedbacks[feedback.id] = feedback
 
-    logger.info(f'end: convert_sz_date_to_timestamp()')
-    return timestamp
+                # stop if everything was found
+                if len(answered_feedbacks) == len(wanted_ids):
+                    break
+    except FeedbacksRequestError as e:
+        logger.warning(f'get_answered_feedbacks(): {e} for {shop.code}')
 
+    logger.info(f'end: get_answered_feedbacks() for {shop.code}. Found {len(answered_feedbacks)} '
+                f'of {len(wanted_ids)}')
+    return answered_feedbacks
 
-def is_time_between_9_and_21(date_string):
-    logger.info(f'start: is_time_between_9_and_21()')
 
-    date_obj = datetime.datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ")
-    date_obj += datetime.timedelta(hours=3)  # Установка времени МСК
+# returns None if request failed and can be repeated later. Raises ReviewNotFoundError if review doesn't exist
+def get_review_by_id(review_id, shop: shop_registry.Shop):
+    logger.debug(f'start: get_review_by_id() for {shop.code}')
 
-    start_time = datetime.datetime(date_obj.year, date_obj.month, date_obj.day, 9, 0, 0)
-    end_time = datetime.datetime(date_obj.year, date_obj.month, date_obj.day, 21, 0, 0)
+    path = '/api/v1/feedback'
+    params = {
+        'id': f'{review_id}'
+    }
 
-    if start_time <= date_obj <= end_time:
-        logger.info(f'end: is_time_between_9_and_21()')
-        return True
+    response, is_not_found = request_with_retry(path, params, shop)
+    if response is None and is_not_found:
+        logger.warning(f'end: get_review_by_id() for {shop.code}. Review {review_id} is not found')
+        raise ReviewNotFoundError(f'review {review_id} is not found')
+    elif response is None:
+        logger.warning(f'end: get_review_by_id() with None for {shop.code}')
+        return None
     else:
-        logger.info(f'end: is_time_between_9_and_21()')
-        return False
+        logger.debug(f'end: get_review_by_id() for {shop.code}')
+        return Feedback.from_json(response.json()['data'])
+
+
+# returns response or None if request failed
+def get_response_with_retry(path, params, shop: shop_registry.Shop):
+    response, _ = request_with_retry(path, params, shop)
+    return response
+
+
+# returns (response, is_not_found). Response is None if request failed, is_not_found is True if WB answered that
+# requested object doesn't exist (404 or 422 of stale ID), so there is no sense to repeat the request later
+def request_with_retry(path, params, shop: shop_registry.Shop):
+    logger.debug(f'start: request_with_retry() for {shop.code}')
+
+    breaker = retry_policy.get_breaker(shop.code)
+    if not breaker.allow_request():
+        logger.warning(f'end: request_with_retry() for {shop.code}. Circuit breaker is open, request is skipped')
+        wb_skipped_requests.inc(shop=shop.code)
+        return None, False
+
+    attempt = 0
+    while True:
+        try:
+            with wb_request_time.time(shop=shop.code):
+                response = wb_client.get(path, params, shop)
+            response.raise_for_status()  # Raises an exception for non-2xx responses
+            breaker.record_success()
+            logger.debug(f'end: request_with_retry() for {shop.code}')
+            return response, False
+        except requests.exceptions.RequestException as e:
+            is_retryable = retry_policy.is_retryable(e)
+
+            if is_retryable and attempt < retry_policy.max_retries:
+                retry_delay = retry_policy.get_retry_delay(attempt, e)
+                attempt += 1
+                wb_retries.inc(shop=shop.code)
+                logger.warning(f'Shop {shop.code}. An error occurred: {e}. Retrying in {retry_delay:.1f} seconds...')
+                time.sleep(retry_delay)
+                continue
+
+            if is_retryable:
+                logger.warning(f'Shop {shop.code}. Max retries reached. Could not establish connection.')
+                if breaker.record_failure():
+                    logger.error(f'Shop {shop.code}. Circuit breaker is opened for '
+                                 f'{retry_policy.breaker_reset_timeout} seconds')
+            else:
+                logger.warning(f'Shop {shop.code}. Request failed without retry: {e}')
+                # any response (even 4xx) means API is reachable, so breaker is closed and its trial is finished
+                if e.response is not None:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+
+            wb_failed_requests.inc(shop=shop.code)
+
+            if e.response is not None and e.response.status_code == 422:
+                pattern = r'id=(\d+)'
+                match = re.search(pattern, str(e))
+                if match:
+                    review_id = match.group(1)
+                    db.remove_unanswered_review(review_id)
+                    logger.warning(f'ID ({review_id}) was deleted from db because it does not exist anymore')
+
+            logger.debug(f'end: request_with_retry() for {shop.code}')
+            return None, e.response is not None and e.response.status_code in not_found_status_codes
+        except Exception as e:
+            logger.error(f'Unknown exception in request_with_retry(): {e}')
+            wb_failed_requests.inc(shop=shop.code)
+            breaker.record_failure()
+            logger.debug(f'end: request_with_retry() for {shop.code}')
+            return None, False
+
+
+# product lines of message. Fields which are missing in feedback are taken from cache of products
+def format_product(feedback: Feedback):
+    product_name = feedback.product_name
+    supplier_article = feedback.supplier_article
+
+    if product_name is None or supplier_article is None:
+        product = db.get_product(feedback.nm_id)
+        if product is not None:
+            product_name = product_name or product.name
+            supplier_article = supplier_article or product.supplier_article
+
+    lines = []
+    if product_name is not None:
+        lines.append('<b>Товар:</b> ' + html.escape(product_name))
+    if supplier_article is not None:
+        lines.append('<b>Артикул продавца:</b> ' + html.escape(supplier_article))
+    # '0' is size of products without sizes
+    if feedback.size is not None and feedback.size != '0':
+        lines.append('<b>Размер:</b> ' + html.escape(str(feedback.size)))
+    lines.append(f'<b>Артикул:</b> {feedback.nm_id}')
+
+    return '\n'.join(lines)
+
+
+# Unix TimeStamp to MSK date string
+def format_date(timestamp):
+    msk_datetime = datetime.datetime.fromtimestamp(timestamp, msk_timezone)
+    return msk_datetime.strftime('%Y-%m-%d %H:%M')
+
+
+def is_time_between_9_and_21(timestamp):
+    msk_datetime = datetime.datetime.fromtimestamp(timestamp, msk_timezone)
+    return 9 <= msk_datetime.hour < 21 or msk_datetime.time() == datetime.time(21, 0, 0)
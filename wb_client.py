@@ -0,0 +1,40 @@
+import config
+import requests
+import threading
+import shop_registry
+from requests.adapters import HTTPAdapter
+
+# settings from "wb_api" section of config.json
+api_settings = config.get('wb_api', {})
+base_url = api_settings.get('base_url', 'https://feedbacks-api.wb.ru')
+connect_timeout = api_settings.get('connect_timeout', 5)  # seconds
+read_timeout = api_settings.get('read_timeout', 20)  # seconds
+pool_size = api_settings.get('pool_size', 4)  # keep-alive connections per shop
+
+sessions = {}  # {shop code: requests.Session}
+locker = threading.Lock()
+
+
+# session keeps connections to WB alive, so TCP and TLS handshakes are made once, not for every request
+def get_session(shop: shop_registry.Shop):
+    with locker:
+        session = sessions.get(shop.code)
+
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'Authorization': f'{shop.token}',
+                'Accept-Encoding': 'gzip, deflate'
+            })
+
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            sessions[shop.code] = session
+
+        return session
+
+
+def get(path, params, shop: shop_registry.Shop):
+    return get_session(shop).get(base_url + path, params=params, timeout=(connect_timeout, read_timeout))
@@ -0,0 +1,114 @@
+import ssl
+import hmac
+import time
+import config
+import telebot
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from log_writer import get_logger
+
+logger = get_logger(__name__)
+
+# settings from "webhook" of "telegram" section of config.json
+settings = config.get('telegram', {}).get('webhook', {})
+is_enabled = settings.get('enabled', False)  # updates are received by webhook instead of long polling
+url = settings.get('url', '').rstrip('/')  # public https address, telegram sends updates to url/<bot name>
+host = settings.get('host', '0.0.0.0')
+port = settings.get('port', 8443)
+secret_token = settings.get('secret_token', '')  # telegram sends it in header, so fake updates are rejected
+certificate = settings.get('certificate')  # self-signed certificate, not needed behind reverse proxy
+private_key = settings.get('private_key')
+workers = settings.get('workers', 4)  # threads which run handlers of both bots
+max_pending = settings.get('max_pending', 100)  # updates waiting for worker, others are rejected
+
+# without secret token anyone who knows url can send fake updates. It's checked on import,
+# so bot stops before any thread is started
+if is_enabled and secret_token == '':
+    raise RuntimeError('secret_token of telegram.webhook in config.json must be set to use webhook')
+
+bots = {}  # {bot name: telebot.TeleBot}
+executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook')
+pending = threading.BoundedSemaphore(max_pending)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        # the last part of path is bot name, so reverse proxy can add its own prefix
+        bot = bots.get(self.path.rstrip('/').rsplit('/', 1)[-1])
+        if bot is None:
+            self.send_response_only(404)
+            self.end_headers()
+            return
+
+        if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret_token):
+            logger.warning(f'Webhook update with wrong secret token from {self.client_address[0]}')
+            self.send_response_only(403)
+            self.end_headers()
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        # telegram repeats update later if it's not accepted, so it's not lost when workers are busy
+        if not pending.acquire(blocking=False):
+            logger.warning('Webhook update was rejected: too many pending updates')
+            self.send_response_only(503)
+            self.end_headers()
+            return
+
+        try:
+            executor.submit(process_update, bot, body.decode('utf-8'))
+        except Exception:
+            pending.release()
+            raise
+
+        # answer at once, handlers are run by workers
+        self.send_response_only(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def process_update(bot: telebot.TeleBot, update_json):
+    try:
+        bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+    except Exception as e:
+        logger.error(f'Error while processing webhook update: {e}')
+    finally:
+        pending.release()
+
+
+# sets webhooks of bots {bot name: bot} and starts server which receives updates of all of them
+def start(named_bots):
+    bots.update(named_bots)
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+
+    if certificate is not None and private_key is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate, private_key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.serve_forever, name='webhook_server').start()
+    logger.info(f'Webhook server is listening on {host}:{port}')
+
+    threading.Thread(target=set_webhooks, name='set_webhooks', daemon=True).start()
+
+
+def set_webhooks():
+    for name, bot in bots.items():
+        while True:
+            try:
+                if certificate is not None:
+                    with open(certificate, 'rb') as file:
+                        bot.set_webhook(url=f'{url}/{name}', certificate=file, secret_token=secret_token)
+                else:
+                    bot.set_webhook(url=f'{url}/{name}', secret_token=secret_token)
+
+                logger.info(f'Webhook is set for {name}: {url}/{name}')
+                break
+            except Exception as e:
+                logger.warning(f'Error while setting webhook for {name}: {e}\nRetry in 10 seconds...')
+                time.sleep(10)